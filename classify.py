@@ -28,62 +28,212 @@ SOFTWARE.
 """
 
 import os
-import sys
-import sqlite3
+import json
+import time
 import pickle
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing.text import Tokenizer
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-from transform import get_and_normalize
-
-def get_category_members(db, category):
-    db = db.execute('''
-    SELECT title
-    FROM pages
-    JOIN category_listing ON category_listing.page_id = pages.id
-    WHERE category_listing.category_id = (SELECT id FROM categories WHERE name LIKE ?);
-    ''', [category])
+import sqlite3
+import argparse
+import database
+from transform import DEFAULT_CHUNK_SIZE, get_all_pages, get_category_pages, get_pages_by_id, iter_chunks, iter_normalized, open_cache
+
+# categories printed per page for a model of several categories
+TOP_CATEGORIES = 5
+
+# pages scored per predict call
+DEFAULT_BATCH_SIZE = 256
+
+def read_model_categories(modelfile):
+    # written next to the model by learn.py --categories, one per output
+    filename = os.path.splitext(modelfile)[0] + '.categories'
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def load_classifier(modelfile, tokenizerfile):
+    # returns a function scoring a list of normalized texts, giving a
+    # (pages, categories) array, and the categories of a multi-category
+    # model; tensorflow is only imported for keras models
+    if modelfile.endswith('.npz'):
+        import linear
+        model = linear.LinearModel.load(modelfile)
+        return model.predict, model.categories if len(model.categories) > 1 else None
+
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras.preprocessing.sequence import pad_sequences
 
-    return db.fetchall()
+    model = load_model(modelfile)
+    max_length = int(tokenizerfile.rsplit('.', 2)[1])
+    with open(tokenizerfile, 'rb') as f:
+        tokenizer = pickle.load(f)
 
-def get_page_content(db, page):
+    def predict(texts):
+        sequences = tokenizer.texts_to_sequences(texts)
+        return model.predict_on_batch(pad_sequences(sequences, maxlen=max_length, truncating='post'))
+
+    return predict, read_model_categories(modelfile)
+
+def read_id_list(filename):
+    # page ids, one per line, in the id order pages are classified in
+    with open(filename, 'r') as f:
+        return sorted(set(int(line) for line in f if line.strip()))
+
+def resume_output(filename):
+    # returns the id of the last complete line of a previous run, and cuts
+    # off a line left half written if that run was interrupted
+    last_id = 0
+    end = 0
+    with open(filename, 'rb+') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            last_id = json.loads(line)['id']
+            end += len(line)
+        f.truncate(end)
+
+    return last_id
+
+def iter_scores(pages, predict, batch_size, chunk_size, workers=1, cache=None):
+    """Scores (id, title, content) rows in batches.
+
+    Pages are read and normalized chunk_size at a time and scored batch_size
+    at a time. Yields lists of (id, title, scores) in the order the rows came
+    in, so only a few chunks of pages are held at once.
+    """
+    normalized = (row for chunk in iter_normalized(iter_chunks(pages, chunk_size), workers, cache=cache) for row in chunk)
+    for batch in iter_chunks(normalized, batch_size):
+        scores = predict([text for _, _, text in batch])
+        yield [(page_id, title, score) for (page_id, title, _), score in zip(batch, scores)]
+
+def to_json_line(page_id, title, scores, categories):
+    row = {'id': page_id, 'title': title}
+    if categories is None:
+        row['score'] = round(float(scores[0]), 6)
+    else:
+        row['scores'] = {name: round(float(score), 6) for name, score in zip(categories, scores)}
+
+    return json.dumps(row, ensure_ascii=False) + '\n'
+
+def create_prediction_tables(db):
+    # models records every model and threshold predictions were stored for;
+    # predictions only holds the scores at or above that threshold
+    db.execute('''
+    CREATE TABLE IF NOT EXISTS models (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL,
+        modified REAL NOT NULL,
+        backend TEXT NOT NULL,
+        categories TEXT NOT NULL,
+        threshold REAL NOT NULL,
+        created TEXT NOT NULL,
+        UNIQUE (path, modified, threshold)
+    )
+    ''')
+    db.execute('''
+    CREATE TABLE IF NOT EXISTS predictions (
+        model_id INTEGER NOT NULL,
+        category TEXT NOT NULL COLLATE NOCASE,
+        page_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (model_id, category, page_id)
+    ) WITHOUT ROWID
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS predictions_category_score ON predictions(category, score)')
+    db.commit()
+
+def get_model_id(db, modelfile, categories, threshold):
+    # the same model file, unchanged and with the same threshold, reuses its
+    # row, so a resumed or repeated run adds to the same predictions
+    path = os.path.realpath(modelfile)
+    modified = os.path.getmtime(modelfile)
+    row = db.execute('''
+    SELECT id
+    FROM models
+    WHERE path = ? AND modified = ? AND threshold = ?;
+    ''', [path, modified, threshold]).fetchone()
+    if row is not None:
+        return row[0]
+
+    backend = 'linear' if modelfile.endswith('.npz') else 'keras'
+    cursor = db.execute('''
+    INSERT INTO models (path, modified, backend, categories, threshold, created)
+    VALUES (?, ?, ?, ?, ?, datetime('now'));
+    ''', [path, modified, backend, json.dumps(categories), threshold])
+    db.commit()
+
+    return cursor.lastrowid
+
+def store_predictions(db, model_id, batch, categories, threshold):
+    # one executemany and commit per batch; returns the rows stored
+    rows = []
+    for page_id, _, scores in batch:
+        for name, score in zip(categories, scores):
+            if score >= threshold:
+                rows.append((model_id, name, page_id, float(score)))
+
+    db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)', rows)
+    db.commit()
+
+    return len(rows)
+
+def get_candidates(db, category, threshold):
+    # pages scored at or above threshold for the category by any stored
+    # model that are not in it yet, best first; a range scan of the
+    # (category, score) index
     db = db.execute('''
-    SELECT content
-    FROM pages
-    WHERE title LIKE ?;
-    ''', [page])
-
-    return db.fetchone()[0]
+    SELECT pages.id, pages.title, max(predictions.score) AS score
+    FROM predictions
+    JOIN pages ON pages.id = predictions.page_id
+    WHERE predictions.category = ? AND predictions.score >= ?
+    AND NOT EXISTS (
+        SELECT 1
+        FROM category_listing
+        WHERE category_listing.page_id = pages.id
+        AND category_listing.category_id = (SELECT id FROM categories WHERE name LIKE ?)
+    )
+    GROUP BY pages.id
+    ORDER BY score DESC;
+    ''', [category, threshold, category])
+
+    return db
 
 def main():
-    category = sys.argv[1]
-    certainthreshold = float(sys.argv[2])
-    modelfile = sys.argv[3]
-    tokenizerfile = sys.argv[4]
-    dbfile = sys.argv[5]
-
-    if not category:
-        print("Error: no category specified.")
-        return
-
-    if not certainthreshold:
-        print("Error: no certainthreshold specified.")
-        return
-
-    if not modelfile:
-        print("Error: no modelfile specified.")
-        return
-
-    if not tokenizerfile:
-        print("Error: no tokenizerfile specified.")
-        return
-
-    if not dbfile:
-        print("Error: no dbfile specified.")
-        return
-
-    if not category and not certainthreshold and not modelfile and not tokenizerfile and not dbfile:
-        print("Usage: python classify.py <category> <certainty> <modelfile> <tokenizerfile> <dbfile>")
+    parser = argparse.ArgumentParser(description='Score pages with a model trained by learn.py.')
+    parser.add_argument('category', help='category whose members are classified (unless --all or --ids), and the name scores of a single-category model are stored under')
+    parser.add_argument('certainthreshold', type=float, help='certainty a page needs to count as in the category')
+    parser.add_argument('modelfile', help='model written by learn.py (.keras or .npz)')
+    parser.add_argument('tokenizerfile', help='tokenizer written by learn.py for a .keras model (any value for a .npz model)')
+    parser.add_argument('dbfile', help='database file to use')
+    parser.add_argument('--all', action='store_true', help='classify every page in the database')
+    parser.add_argument('--ids', metavar='FILE', help='classify the pages whose ids are listed in FILE (one per line)')
+    parser.add_argument('--after-id', type=int, default=0, help='only classify pages with a larger id')
+    parser.add_argument('--output', metavar='FILE', help='append the scores to FILE as JSON Lines while classifying')
+    parser.add_argument('--resume', action='store_true', help='continue after the last page in the --output file')
+    parser.add_argument('--save', action='store_true', help='store the scores at or above certainthreshold in the predictions table')
+    parser.add_argument('--candidates', action='store_true', help='list stored predictions at or above certainthreshold for pages not in the category yet, without running the model')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='pages scored per prediction')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='pages read and normalized at a time')
+    parser.add_argument('--workers', type=int, default=1, help='processes to normalize pages with (0 for one per core)')
+
+    args = parser.parse_args()
+    category = args.category
+    modelfile = args.modelfile
+    dbfile = args.dbfile
+    threshold = args.certainthreshold
+    workers = args.workers or os.cpu_count()
+
+    if args.candidates:
+        if not os.path.exists(dbfile):
+            print("Error: dbfile does not exist.")
+            return
+
+        db = database.connect(dbfile)
+        try:
+            for _, title, score in get_candidates(db, category, threshold):
+                print(title + " - " + str(score))
+        except sqlite3.OperationalError as e:
+            print(f"Error: {e}")
+        database.close(db)
         return
 
     if not os.path.exists(modelfile):
@@ -94,69 +244,99 @@ def main():
         print("Error: dbfile does not exist.")
         return
 
-    db = sqlite3.connect(dbfile)
-    cursor = db.cursor()
-    members = get_category_members(db, category)
-    max_length = int(tokenizerfile.split('.')[1])
-
-
-    print("Loading model... ", end="")
-    model = load_model(modelfile)
-    print("Done.")
-
-    print("Loading tokenizer... ", end="")
-    tokenizer = None
-    with open(tokenizerfile, 'rb') as f:
-        tokenizer = pickle.load(f)
-
-    print("Done.")
+    if args.resume and not args.output:
+        print("Error: --resume needs --output.")
+        return
 
-    # get and normalize the content
-    print("Getting and normalizing content...")
-    page_title_content = []
-    for member in members:
-        title = member[0]
-        content = get_and_normalize(cursor, title)
-        page_title_content.append((title, content))
-        print("\rPages normalized: " + str(len(page_title_content)), end="")
+    after_id = args.after_id
+    if args.resume and os.path.exists(args.output):
+        after_id = max(after_id, resume_output(args.output))
+        print(f"Resuming after page {after_id}.")
 
-    print()
-    print("Done.")
+    db = database.connect(dbfile)
 
-    # tokenize the content
-    print("Tokenizing content... ", end="")
-    texts = []
-    for page in page_title_content:
-        texts.append(page[1])
-
-    sequences = tokenizer.texts_to_sequences(texts)
-    data = pad_sequences(sequences, maxlen=max_length)
+    print("Loading model... ", end="")
+    predict, categories = load_classifier(modelfile, args.tokenizerfile)
     print("Done.")
 
-    # classify the content
-    print("Classifying content...", end="")
-    predictions = model.predict(data)
-    print("Done.")
+    model_id = None
+    if args.save:
+        # written through the same writable connection as the cache
+        try:
+            save_db = database.connect(dbfile, read_only=False)
+            create_prediction_tables(save_db)
+            model_id = get_model_id(save_db, modelfile, categories or [category], threshold)
+        except sqlite3.OperationalError as e:
+            print(f"Error: cannot store predictions: {e}")
+            return
+
+    # pages are read in id order, so a run can be continued after any id
+    cache = open_cache(dbfile)
+    pages_db = cache.db if cache is not None else db
+    if args.ids:
+        pages = get_pages_by_id(pages_db, [page_id for page_id in read_id_list(args.ids) if page_id > after_id])
+    elif args.all:
+        pages = get_all_pages(pages_db, after_id)
+    else:
+        pages = get_category_pages(pages_db, category, after_id)
+
+    batches = iter_scores(pages, predict, args.batch_size, args.chunk_size, workers, cache)
+
+    if args.output or args.save:
+        print("Classifying pages...")
+        classified = 0
+        stored = 0
+        started = time.perf_counter()
+        out = open(args.output, 'a') if args.output else None
+        for batch in batches:
+            if out is not None:
+                for page_id, title, scores in batch:
+                    out.write(to_json_line(page_id, title, scores, categories))
+                out.flush()
+            if model_id is not None:
+                stored += store_predictions(save_db, model_id, batch, categories or [category], threshold)
+
+            classified += len(batch)
+            rate = classified / max(time.perf_counter() - started, 1e-9)
+            print(f"\rPages classified: {classified} ({rate:.1f} pages/sec)", end="")
+
+        print()
+        if out is not None:
+            out.close()
+        if model_id is not None:
+            print(f"Predictions stored: {stored} (model {model_id})")
+        database.close(db)
+        print("Done.")
+        return
 
     # print the results
     print("Results:")
-    results = []
-    for i in range(len(page_title_content)):
-        page = page_title_content[i]
-        prediction = predictions[i]
-        certainty = prediction[0]
-
-        # only add those with a good probability of being in the category
-        
+    if categories is not None:
+        # every category was scored in the same pass, show each page's best
+        for batch in batches:
+            for _, title, scores in batch:
+                best = sorted(zip(scores, categories), reverse=True)[:TOP_CATEGORIES]
+                best = [(score, name) for score, name in best if score >= threshold]
+                if best:
+                    print(title + " - " + ", ".join(f"{name} {score:.3f}" for score, name in best))
+
+        database.close(db)
+        print("Done.")
+        return
 
-        results.append((page[0], certainty))
+    results = []
+    for batch in batches:
+        for _, title, scores in batch:
+            # only add those with a good probability of being in the category
+            if scores[0] >= threshold:
+                results.append((title, scores[0]))
 
     results.sort(key=lambda x: x[1])
     for result in results:
         print(result[0] + " - " + str(result[1]))
-            
-    db.close()
+
+    database.close(db)
     print("Done.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
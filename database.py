@@ -0,0 +1,79 @@
+"""
+File: database.py
+Author: Hypirae 2023
+Version: 1.0.0
+
+License: MIT
+MIT License
+
+Copyright (c) 2023 Hypirae
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+# pragmas applied to every connection handed out by connect(); the cache is
+# per connection, mmap lets reads come straight from the OS page cache
+MMAP_SIZE = 1 << 30
+CACHE_SIZE = -65536
+CONNECTION_PRAGMAS = [
+    f'mmap_size = {MMAP_SIZE}',
+    f'cache_size = {CACHE_SIZE}',
+    'temp_store = MEMORY',
+]
+
+# prepared statements kept per connection (sqlite3 keys them on the SQL text)
+STATEMENT_CACHE_SIZE = 256
+
+# open connections by (process, thread, path, read_only); a forked child must
+# not reuse its parent's connection and sqlite3 connections cannot be used
+# from another thread, so the pid and thread are part of the key
+connections = {}
+
+def connect(dbfile, read_only=True):
+    """Returns a shared, tuned connection to dbfile.
+
+    Connections are read-only unless read_only=False is passed, and are
+    reused by later calls from the same thread with the same arguments
+    until close() is called.
+    """
+    key = (os.getpid(), threading.get_ident(), os.path.realpath(dbfile), read_only)
+    db = connections.get(key)
+    if db is not None:
+        return db
+
+    uri = Path(dbfile).absolute().as_uri()
+    if read_only:
+        uri += '?mode=ro'
+    db = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in CONNECTION_PRAGMAS:
+        db.execute(f'PRAGMA {pragma}')
+
+    connections[key] = db
+    return db
+
+def close(db):
+    for key, value in list(connections.items()):
+        if value is db:
+            del connections[key]
+    db.close()
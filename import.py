@@ -27,166 +27,764 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import os
 import re
+import bz2
+import gzip
+import hashlib
 import sys
+import time
 import sqlite3
+import argparse
+import multiprocessing
 import xml.etree.ElementTree as ET
+from array import array
+from collections import deque
+from functools import partial
+from itertools import chain
 
 CATEGORIES_TABLE_NAME = 'categories'
 CATEGORY_LISTING_TABLE_NAME = 'category_listing'
 PAGES_TABLE_NAME = 'pages'
+PAGES_FTS_TABLE_NAME = 'pages_fts'
 
-categories = []
-category_id = 0
+# stored in PRAGMA user_version; 0 is the original layout without keys,
+# 1 adds keys and indexes, 2 adds the full-text index, 3 moves the revision
+# columns in front of the content
+SCHEMA_VERSION = 3
 
-def print_help():
-    print('Usage: python import.py <file> <db>')
-    print('    file: XML file to import')
-    print('    db:   SQLite database to create')
+# namespace used by the dump if the root element does not declare one
+DEFAULT_XML_NAMESPACE = '{http://www.mediawiki.org/xml/export-0.11/}'
 
-def add_category(category):
-    global category_id
+# rows buffered before they are flushed with executemany
+DEFAULT_BATCH_SIZE = 10000
+
+# pages handed to a parser worker at a time, and bytes read per block
+DEFAULT_CHUNK_SIZE = 200
+READ_BLOCK_SIZE = 1 << 20
+
+# markers used to split the raw dump into pages; a literal </page> inside
+# page text is always escaped, so the closing tag is unambiguous
+MEDIAWIKI_START = b'<mediawiki'
+PAGE_START = b'<page>'
+PAGE_END = b'</page>'
+
+# compressed dumps are recognised by their magic bytes, not their extension
+GZIP_MAGIC = b'\x1f\x8b'
+BZ2_MAGIC = b'BZh'
+
+# start of every stream in a multi-stream bz2 file (header + block magic)
+BZ2_STREAM_HEADER = re.compile(rb'BZh[1-9]1AY&SY')
+BZ2_STREAM_HEADER_LENGTH = 10
+
+# give up on parallel bz2 decompression if no stream boundary shows up
+# within this many compressed bytes (i.e. a single-stream file); the
+# streams of multi-stream dumps hold about 100 pages each, well under this
+BZ2_SEGMENT_LIMIT = 4 << 20
+
+# pragmas applied while bulk loading, and the safe settings restored afterwards
+BULK_LOAD_PRAGMAS = [
+    'journal_mode = MEMORY',
+    'synchronous = OFF',
+    'cache_size = -262144',
+    'temp_store = MEMORY',
+]
+SAFE_PRAGMAS = [
+    'journal_mode = DELETE',
+    'synchronous = FULL',
+    'cache_size = -2000',
+    'temp_store = DEFAULT',
+]
+
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x1F\x7F-\x9F]')
+CATEGORY_LINK = re.compile(r'\[\[Category:([^\]]+)\]\]')
+
+# category registry: name -> id, with names and member page ids indexed by id
+category_ids = {}
+category_names = []
+category_members = []
+
+class BulkWriter:
+    """Buffers rows and writes them with executemany.
+
+    Rows are kept in the order they were added and consecutive rows for the
+    same statement are written with one executemany call. Every flush is
+    committed as a single transaction, so a batch size of 1 behaves like the
+    old one-insert-one-commit path. With commit=False nothing is committed
+    and the caller decides when the whole transaction is done.
+    """
+
+    def __init__(self, db, batch_size=DEFAULT_BATCH_SIZE, commit=True):
+        self.db = db
+        self.commit = commit
+        self.batch_size = max(1, batch_size)
+        self.pending = []
+        self.buffered = 0
+        self.rows_written = 0
+        self.started = time.time()
+
+    def add(self, table, row):
+        placeholders = ', '.join('?' * len(row))
+        self.execute(f'INSERT INTO {table} VALUES ({placeholders})', row)
+
+    def execute(self, statement, row):
+        if self.pending and self.pending[-1][0] == statement:
+            self.pending[-1][1].append(row)
+        else:
+            self.pending.append((statement, [row]))
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for statement, rows in self.pending:
+            self.db.executemany(statement, rows)
+            self.rows_written += len(rows)
+        self.pending = []
+        self.buffered = 0
+        if self.commit:
+            self.db.commit()
+
+    def rows_per_second(self):
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.rows_written / elapsed
+
+class BlockReader:
+    """Minimal read-only file object over an iterator of byte blocks."""
+
+    def __init__(self, blocks, source=None):
+        self.blocks = blocks
+        self.source = source
+        self.block = b''
+        self.pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.block):
+                self.block = next(self.blocks, b'')
+                self.pos = 0
+                if not self.block:
+                    break
+            end = len(self.block)
+            if size > 0:
+                end = min(end, self.pos + size)
+                size -= end - self.pos
+            parts.append(self.block[self.pos:end])
+            self.pos = end
+
+        return b''.join(parts)
+
+    def close(self):
+        self.blocks.close()
+        if self.source is not None:
+            self.source.close()
+
+def apply_pragmas(db, pragmas):
+    for pragma in pragmas:
+        db.execute(f'PRAGMA {pragma}')
+
+def clean_category_name(category):
     if category == '':
-        return
-    category = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', category)
+        return None
+    category = CONTROL_CHARACTERS.sub('', category)
     category = category.strip()
-    if any(c['name'] == category for c in categories):
-        return
     if '|' in category:
-        return
-    categories.append({
-        'id': category_id,
-        'name': category,
-        'page_ids': [],
-    })
-    category_id += 1
+        return None
+    return category
+
+def add_category(category):
+    # returns the id of a newly registered category, None if it was known
+    if category is None or category in category_ids:
+        return None
+    category = sys.intern(category)
+    cat_id = len(category_names)
+    category_ids[category] = cat_id
+    category_names.append(category)
+    category_members.append(array('q'))
+    return cat_id
 
 def add_id_to_category(category, page_id):
-    for cat in categories:
-        if cat['name'] == category:
-            if page_id not in cat['page_ids']:
-                cat['page_ids'].append(page_id)
+    cat_id = category_ids.get(category)
+    if cat_id is None:
+        return
+    members = category_members[cat_id]
+    # pages are added one at a time, so a repeated link on the same page
+    # can only ever match the last member
+    if not members or members[-1] != page_id:
+        members.append(page_id)
 
 def extract_categories(page):
-    categories = re.findall(r'\[\[Category:([^\]]+)\]\]', page['content'])
-    return categories
+    return CATEGORY_LINK.findall(page['content'])
+
+def hash_content(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def prepare_page(page):
+    # pair every category link with its cleaned name; the registry is
+    # keyed on the cleaned name, listings are matched on the raw link
+    page['categories'] = [(c, clean_category_name(c)) for c in extract_categories(page)]
+    page['content_hash'] = hash_content(page['content'])
+    return page
+
+def get_namespace(tag):
+    if tag.startswith('{'):
+        return tag[:tag.index('}') + 1]
+    return DEFAULT_XML_NAMESPACE
+
+def read_page(elem, ns):
+    page_content = ''
+    revisions = elem.findall(ns + 'revision')
+    if revisions:
+        # full-history dumps list revisions oldest first
+        text = revisions[-1].find(ns + 'text')
+        if text is not None and text.text is not None:
+            page_content = text.text
+
+    revision_id = None
+    revision_timestamp = None
+    if revisions:
+        revision_id = int(revisions[-1].find(ns + 'id').text)
+        revision_timestamp = revisions[-1].find(ns + 'timestamp').text
+
+    return {
+        'id': int(elem.find(ns + 'id').text),
+        'ns': int(elem.find(ns + 'ns').text),
+        'title': elem.find(ns + 'title').text,
+        'content': page_content,
+        'revision_id': revision_id,
+        'revision_timestamp': revision_timestamp,
+    }
+
+def iter_bz2_blocks(stream, workers):
+    # split a multi-stream bz2 file at its stream headers and decompress
+    # the segments in a worker pool, yielding them in file order; the last
+    # segment, or everything after a segment too long to be a stream, is
+    # decompressed as a stream so it is never held in memory whole
+    max_in_flight = workers * 2
+    pending = deque()
+    buffer = b''
+
+    with multiprocessing.Pool(workers) as pool:
+        while True:
+            block = stream.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            search_from = max(1, len(buffer) - BZ2_STREAM_HEADER_LENGTH)
+            buffer += block
+
+            last = None
+            for match in BZ2_STREAM_HEADER.finditer(buffer, search_from):
+                last = match.start()
+            if last is None:
+                if len(buffer) > BZ2_SEGMENT_LIMIT:
+                    break
+                continue
+
+            pending.append(pool.apply_async(bz2.decompress, (buffer[:last],)))
+            buffer = buffer[last:]
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    rest = chain([buffer], iter(partial(stream.read, READ_BLOCK_SIZE), b''))
+    decompressed = bz2.BZ2File(BlockReader(rest))
+    yield from iter(partial(decompressed.read, READ_BLOCK_SIZE), b'')
+
+def open_dump(file_name, workers=1):
+    # '-' reads from stdin, e.g. `7z x -so dump.7z | python3 import.py - db`
+    if file_name == '-':
+        raw = sys.stdin.buffer
+    else:
+        raw = open(file_name, 'rb')
+
+    magic = raw.peek(len(BZ2_MAGIC))[:len(BZ2_MAGIC)]
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if magic.startswith(BZ2_MAGIC):
+        if workers > 1:
+            return BlockReader(iter_bz2_blocks(raw, workers), raw)
+        return bz2.BZ2File(raw, 'rb')
+
+    return raw
+
+def iter_pages(source):
+    # stream the dump one <page> at a time so memory stays flat
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    ns = get_namespace(root.tag)
+    page_tag = ns + 'page'
+
+    for event, elem in context:
+        if event != 'end' or elem.tag != page_tag:
+            continue
+        page = read_page(elem, ns)
+        if page['ns'] == 0:
+            prepare_page(page)
+        yield page
+        # drop the finished page (and anything before it) from the tree
+        root.clear()
+
+def iter_page_chunks(stream, chunk_size):
+    # split the raw dump into lists of <page> elements without parsing it
+    buffer = b''
+    root_tag = None
+    pages = []
+
+    while True:
+        block = stream.read(READ_BLOCK_SIZE)
+        buffer += block
+
+        if root_tag is None:
+            start = buffer.find(MEDIAWIKI_START)
+            end = buffer.find(b'>', start)
+            if start == -1 or end == -1:
+                if not block:
+                    raise ValueError('no <mediawiki> element found in dump')
+                continue
+            root_tag = buffer[start:end + 1]
+            buffer = buffer[end + 1:]
+
+        pos = 0
+        while True:
+            end = buffer.find(PAGE_END, pos)
+            if end == -1:
+                break
+            start = buffer.find(PAGE_START, pos, end)
+            end += len(PAGE_END)
+            pages.append(buffer[start:end])
+            pos = end
+            if len(pages) >= chunk_size:
+                yield root_tag, pages
+                pages = []
+        buffer = buffer[pos:]
+
+        if not block:
+            break
+
+    if pages:
+        yield root_tag, pages
+
+def parse_page_chunk(chunk):
+    root_tag, pages = chunk
+    root = ET.fromstring(root_tag + b''.join(pages) + b'</mediawiki>')
+    ns = get_namespace(root.tag)
+
+    parsed = []
+    for elem in root:
+        page = read_page(elem, ns)
+        if page['ns'] == 0:
+            prepare_page(page)
+        else:
+            # only counted by the writer, no need to ship the text back
+            page['content'] = ''
+        parsed.append(page)
+
+    return parsed
+
+def iter_pages_parallel(source, workers, chunk_size):
+    # parse chunks in a worker pool, yielding pages in dump order; only a
+    # few chunks are in flight at once so memory stays bounded
+    max_in_flight = workers * 2
+    pending = deque()
+
+    with multiprocessing.Pool(workers) as pool:
+        for chunk in iter_page_chunks(source, chunk_size):
+            pending.append(pool.apply_async(parse_page_chunk, (chunk,)))
+            if len(pending) >= max_in_flight:
+                yield from pending.popleft().get()
+
+        while pending:
+            yield from pending.popleft().get()
 
 def create_tables(db):
     db.execute(f'''
         CREATE TABLE IF NOT EXISTS {CATEGORIES_TABLE_NAME} (
-            id INTEGER,
-            name TEXT
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL
         )
     ''')
     db.execute(f'''
         CREATE TABLE IF NOT EXISTS {CATEGORY_LISTING_TABLE_NAME} (
-            category_id INTEGER,
-            page_id INTEGER,
+            category_id INTEGER NOT NULL,
+            page_id INTEGER NOT NULL,
+            PRIMARY KEY(category_id, page_id),
             FOREIGN KEY(category_id) REFERENCES {CATEGORIES_TABLE_NAME}(id),
             FOREIGN KEY(page_id) REFERENCES {PAGES_TABLE_NAME}(id)
-        )
+        ) WITHOUT ROWID
     ''')
+    create_pages_table(db, PAGES_TABLE_NAME)
+    db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    db.commit()
+
+def create_pages_table(db, name):
+    # the small revision columns come before the content, so reading them
+    # (every incremental import does, for every page) does not have to walk
+    # each page's overflow pages
     db.execute(f'''
-        CREATE TABLE IF NOT EXISTS {PAGES_TABLE_NAME} (
-            id INTEGER,
-            title TEXT,
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            revision_id INTEGER,
+            revision_timestamp TEXT,
+            content_hash TEXT,
             content TEXT
         )
     ''')
 
-def insert_categories(db):
-    for category in categories:
-        db.execute(f'INSERT INTO {CATEGORIES_TABLE_NAME} VALUES (?, ?)', (category['id'], category['name']))
-        
+def create_indexes(db):
+    # built after the bulk load, which is much faster than keeping them
+    # up to date row by row while loading
+    db.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {PAGES_TABLE_NAME}_title ON {PAGES_TABLE_NAME}(title)')
+    db.execute(f'CREATE INDEX IF NOT EXISTS {CATEGORIES_TABLE_NAME}_name ON {CATEGORIES_TABLE_NAME}(name COLLATE NOCASE)')
+    db.execute(f'CREATE INDEX IF NOT EXISTS {CATEGORY_LISTING_TABLE_NAME}_page ON {CATEGORY_LISTING_TABLE_NAME}(page_id, category_id)')
+    db.execute('ANALYZE')
+    db.commit()
+
+def create_fts_index(db):
+    # external-content FTS5 table over pages; filled in one pass once the
+    # bulk load is done, then kept in sync by triggers
+    exists = table_exists(db, PAGES_FTS_TABLE_NAME)
+    db.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {PAGES_FTS_TABLE_NAME} USING fts5(
+            title,
+            content,
+            content='{PAGES_TABLE_NAME}',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    if not exists:
+        db.execute(f"INSERT INTO {PAGES_FTS_TABLE_NAME}({PAGES_FTS_TABLE_NAME}) VALUES ('rebuild')")
+
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {PAGES_TABLE_NAME}_fts_insert AFTER INSERT ON {PAGES_TABLE_NAME} BEGIN
+            INSERT INTO {PAGES_FTS_TABLE_NAME}(rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {PAGES_TABLE_NAME}_fts_delete AFTER DELETE ON {PAGES_TABLE_NAME} BEGIN
+            INSERT INTO {PAGES_FTS_TABLE_NAME}({PAGES_FTS_TABLE_NAME}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {PAGES_TABLE_NAME}_fts_update AFTER UPDATE ON {PAGES_TABLE_NAME} BEGIN
+            INSERT INTO {PAGES_FTS_TABLE_NAME}({PAGES_FTS_TABLE_NAME}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO {PAGES_FTS_TABLE_NAME}(rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+    ''')
     db.commit()
 
-def insert_category_listing(db):
-    for category in categories:
-        for page_id in category['page_ids']:
-            db.execute(f'INSERT INTO {CATEGORY_LISTING_TABLE_NAME} VALUES (?, ?)', (category['id'], page_id))
-            
+def get_schema_version(db):
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+def table_exists(db, name):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [name]).fetchone() is not None
+
+def migrate_to_v1(db):
+    # databases from before incremental imports lack the revision columns
+    columns = [row[1] for row in db.execute(f'PRAGMA table_info({PAGES_TABLE_NAME})')]
+    for column, column_type in (('revision_id', 'INTEGER'), ('revision_timestamp', 'TEXT'), ('content_hash', 'TEXT')):
+        if column not in columns:
+            db.execute(f'ALTER TABLE {PAGES_TABLE_NAME} ADD COLUMN {column} {column_type}')
+
+    # sqlite cannot add keys to a table, so copy everything into new ones;
+    # duplicate rows from importing twice are dropped (newest page wins)
+    tables = (PAGES_TABLE_NAME, CATEGORIES_TABLE_NAME, CATEGORY_LISTING_TABLE_NAME)
+    for table in tables:
+        db.execute(f'ALTER TABLE {table} RENAME TO {table}_v0')
+    create_tables(db)
+    db.execute(f'''
+        INSERT OR REPLACE INTO {PAGES_TABLE_NAME}
+        SELECT id, title, revision_id, revision_timestamp, content_hash, content
+        FROM {PAGES_TABLE_NAME}_v0 ORDER BY rowid
+    ''')
+    db.execute(f'''
+        INSERT OR IGNORE INTO {CATEGORIES_TABLE_NAME}
+        SELECT id, name FROM {CATEGORIES_TABLE_NAME}_v0 ORDER BY rowid
+    ''')
+    db.execute(f'''
+        INSERT OR IGNORE INTO {CATEGORY_LISTING_TABLE_NAME}
+        SELECT category_id, page_id FROM {CATEGORY_LISTING_TABLE_NAME}_v0
+    ''')
+    for table in tables:
+        db.execute(f'DROP TABLE {table}_v0')
     db.commit()
 
-def insert_page(db, page):
-    db.execute(f'INSERT INTO {PAGES_TABLE_NAME} VALUES (?, ?, ?)', (page['id'], page['title'], page['content']))
+def migrate_to_v3(db):
+    # copy the pages into a table with the new column order; the ids are
+    # kept, so the full-text index stays valid, and the indexes and triggers
+    # dropped with the old table are created again by migrate()
+    db.execute(f'DROP TABLE IF EXISTS {PAGES_TABLE_NAME}_v3')
+    create_pages_table(db, f'{PAGES_TABLE_NAME}_v3')
+    db.execute(f'''
+        INSERT INTO {PAGES_TABLE_NAME}_v3
+        SELECT id, title, revision_id, revision_timestamp, content_hash, content
+        FROM {PAGES_TABLE_NAME} ORDER BY id
+    ''')
+    db.execute(f'DROP TABLE {PAGES_TABLE_NAME}')
+    db.execute(f'ALTER TABLE {PAGES_TABLE_NAME}_v3 RENAME TO {PAGES_TABLE_NAME}')
     db.commit()
 
-def main():
-    if len(sys.argv) == 2:
-        if sys.argv[1] == '--help' or sys.argv[1] == '-h':
-            print_help()
-            return
+def migrate(db):
+    version = get_schema_version(db)
+    if version > SCHEMA_VERSION:
+        raise ValueError(f'database schema version {version} is newer than this tool ({SCHEMA_VERSION})')
+    if version < 1 and table_exists(db, PAGES_TABLE_NAME):
+        print('Migrating database to schema version 1...')
+        migrate_to_v1(db)
+    elif version < 3 and table_exists(db, PAGES_TABLE_NAME):
+        print('Migrating database to schema version 3...')
+        migrate_to_v3(db)
 
-    if len(sys.argv) < 3:
-        print('Error: not enough arguments.')
-        print_help()
+    create_tables(db)
+    create_indexes(db)
+    if version < 2:
+        print('Building full-text index...')
+    create_fts_index(db)
+
+def load_categories(db):
+    for cat_id, name in db.execute(f'SELECT id, name FROM {CATEGORIES_TABLE_NAME} ORDER BY id'):
+        category_ids[name] = cat_id
+        while len(category_names) <= cat_id:
+            category_names.append(None)
+            category_members.append(array('q'))
+        category_names[cat_id] = name
+
+def load_page_revisions(db):
+    # {page id: (revision id, content hash)} and {title: page id}
+    revisions = {}
+    titles = {}
+    for page_id, title, revision_id, content_hash in db.execute(f'SELECT id, title, revision_id, content_hash FROM {PAGES_TABLE_NAME}'):
+        revisions[page_id] = (revision_id, content_hash)
+        titles[title] = page_id
+
+    return revisions, titles
+
+def displace_title(writer, page_id):
+    # titles are unique, so a page taking over the title of a page that has
+    # not been read yet (deleted and recreated under a new id, or moved)
+    # first moves that page to a placeholder; it gets its real title back
+    # when it is read, or is deleted at the end if it is gone
+    writer.execute(f'UPDATE {PAGES_TABLE_NAME} SET title = ? WHERE id = ?', (f'\x00displaced {page_id}', page_id))
+
+def insert_categories(writer):
+    for cat_id, name in enumerate(category_names):
+        writer.add(CATEGORIES_TABLE_NAME, (cat_id, name))
+
+    writer.flush()
+
+def insert_category_listing(writer):
+    for cat_id, members in enumerate(category_members):
+        for page_id in members:
+            writer.add(CATEGORY_LISTING_TABLE_NAME, (cat_id, page_id))
+
+    writer.flush()
+
+def page_row(page):
+    return (page['id'], page['title'], page['revision_id'], page['revision_timestamp'], page['content_hash'], page['content'])
+
+def insert_page(writer, page):
+    writer.add(PAGES_TABLE_NAME, page_row(page))
+
+def upsert_page(writer, page, categories_changed):
+    writer.execute(f'''
+        INSERT INTO {PAGES_TABLE_NAME} VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            title = excluded.title,
+            content = excluded.content,
+            revision_id = excluded.revision_id,
+            revision_timestamp = excluded.revision_timestamp,
+            content_hash = excluded.content_hash
+    ''', page_row(page))
+
+    if not categories_changed:
         return
 
-    file_name = sys.argv[1] or ''
-    db_name = sys.argv[2] or ''
+    writer.execute(f'DELETE FROM {CATEGORY_LISTING_TABLE_NAME} WHERE page_id = ?', (page['id'],))
+    cat_ids = []
+    for category, name in page['categories']:
+        # new categories are written before any listing row refers to them
+        new_id = add_category(name)
+        if new_id is not None:
+            writer.add(CATEGORIES_TABLE_NAME, (new_id, name))
+        cat_id = category_ids.get(category)
+        if cat_id is not None and cat_id not in cat_ids:
+            cat_ids.append(cat_id)
+            writer.add(CATEGORY_LISTING_TABLE_NAME, (cat_id, page['id']))
+
+def delete_pages(writer, page_ids):
+    for page_id in page_ids:
+        writer.execute(f'DELETE FROM {CATEGORY_LISTING_TABLE_NAME} WHERE page_id = ?', (page_id,))
+    for page_id in page_ids:
+        writer.execute(f'DELETE FROM {PAGES_TABLE_NAME} WHERE id = ?', (page_id,))
+
+    writer.flush()
+
+def import_full(writer, pages):
     categories_read = 0
     pages_read = 0
     pages_saved = 0
 
+    for page in pages:
+        pages_read += 1
+        if page['ns'] != 0:
+            continue
+        pages_saved += 1
+
+        for category, name in page['categories']:
+            add_category(name)
+            add_id_to_category(category, page['id'])
+            categories_read += 1
+        insert_page(writer, page)
+
+        print(f'\rPages read: {pages_read} (saved {pages_saved})', end='')
+
+    writer.flush()
+    print('\nFinalizing database...')
+    print('Generating categories table...')
+    insert_categories(writer)
+    print('Categories table generated.')
+    print('Generating category listing table...')
+    insert_category_listing(writer)
+    print('Category listing table generated.')
+    print(f'Categories read: {len(category_names)}')
+
+def import_incremental(db, writer, pages):
+    load_categories(db)
+    known_categories = len(category_names)
+    revisions, titles = load_page_revisions(db)
+    seen = set()
+    displaced = set()
+    pages_read = 0
+    added = 0
+    updated = 0
+    unchanged = 0
+
+    for page in pages:
+        pages_read += 1
+        if page['ns'] != 0:
+            continue
+        seen.add(page['id'])
+
+        # titles still maps the titles of pages read so far to their old
+        # ids, but those pages have already been rewritten, so only a page
+        # not read yet can still hold the title in the database
+        holder = titles.get(page['title'])
+        if holder is not None and holder != page['id'] and holder not in seen:
+            displace_title(writer, holder)
+            displaced.add(holder)
+        titles[page['title']] = page['id']
+
+        previous = revisions.get(page['id'])
+        if previous is None:
+            upsert_page(writer, page, True)
+            added += 1
+        elif previous != (page['revision_id'], page['content_hash']) or page['id'] in displaced:
+            # category links only come from the content, so only rewrite
+            # them when the content actually changed
+            upsert_page(writer, page, previous[1] != page['content_hash'])
+            updated += 1
+        else:
+            unchanged += 1
+
+        print(f'\rPages read: {pages_read} (added {added}, updated {updated}, unchanged {unchanged})', end='')
+
+    writer.flush()
+    print('\nFinalizing database...')
+    deleted = [page_id for page_id in revisions if page_id not in seen]
+    delete_pages(writer, deleted)
+    print(f'Pages deleted: {len(deleted)}')
+    print(f'Categories added: {len(category_names) - known_categories}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Import a MediaWiki XML dump into an SQLite database.')
+    parser.add_argument('file', nargs='?', help='XML file to import (.xml, .xml.bz2, .xml.gz or - for stdin)')
+    parser.add_argument('db', nargs='?', help='SQLite database to create')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='rows to buffer per executemany/commit')
+    parser.add_argument('--per-row', action='store_true', help='insert and commit one row at a time without bulk-load pragmas')
+    parser.add_argument('--workers', type=int, default=1, help='parser processes to use (0 for one per core)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='pages handed to a parser process at a time')
+    parser.add_argument('--incremental', action='store_true', help='update an existing database, only touching pages that changed')
+    parser.add_argument('--migrate', metavar='DB', help='upgrade an existing database to the current schema and exit')
+
+    args = parser.parse_args()
+
+    if args.migrate:
+        if not os.path.exists(args.migrate):
+            print('Error: database does not exist.')
+            sys.exit(1)
+        db = sqlite3.connect(args.migrate)
+        migrate(db)
+        db.close()
+        print(f'Database is at schema version {SCHEMA_VERSION}.')
+        return
+
+    if not args.file or not args.db:
+        print('Error: not enough arguments.')
+        parser.print_help()
+        sys.exit(1)
+
+    file_name = args.file
+    db_name = args.db
+    workers = args.workers or os.cpu_count() or 1
+
     print('Creating database...')
     db = sqlite3.connect(db_name)
     print('Database created.')
-    print('Creating tables...')
-    create_tables(db)
-    print('Tables created.')
+    if args.incremental:
+        migrate(db)
+    elif table_exists(db, PAGES_TABLE_NAME) and db.execute(f'SELECT 1 FROM {PAGES_TABLE_NAME} LIMIT 1').fetchone():
+        print('Error: database already contains pages, use --incremental to update it.')
+        db.close()
+        sys.exit(1)
+    else:
+        print('Creating tables...')
+        create_tables(db)
+        print('Tables created.')
+
+    # an incremental update is applied as one transaction, so a failed run
+    # leaves the database as it was instead of half updated; the bulk-load
+    # pragmas would risk corrupting it if the run is killed, so they are only
+    # used to fill a new database
+    commit = not args.incremental
+    bulk_load = not args.per_row and not args.incremental
+    if bulk_load:
+        apply_pragmas(db, BULK_LOAD_PRAGMAS)
+    writer = BulkWriter(db, 1 if args.per_row else args.batch_size, commit)
 
     try:
-        print('Loading XML file...')
-        tree = ET.parse(file_name)
-        root = tree.getroot()
-        print('XML file loaded.')
-
-        # Define the namespace
-        ns = {'ns0': 'http://www.mediawiki.org/xml/export-0.11/'}
-
-        for page in root.findall('.//ns0:page', ns):
-            pages_read += 1
-            page_ns = int(page.find('ns0:ns', ns).text)
-            if page_ns != 0:
-                continue
-            pages_saved += 1
-            page_id = int(page.find('ns0:id', ns).text)
-            page_title = page.find('ns0:title', ns).text
-            revision = page.find('ns0:revision', ns)
-            if revision is not None:
-                page_content = revision.find('ns0:text', ns).text
-            else:
-                page_content = ''
-
-            page_categories = extract_categories({
-                'id': page_id,
-                'title': page_title,
-                'content': page_content,
-            })
-            for category in page_categories:
-                add_category(category)
-                add_id_to_category(category, page_id)
-                categories_read += 1
-            insert_page(db, {
-                'id': page_id,
-                'title': page_title,
-                'content': page_content,
-            })
-
-            print(f'\rPages read: {pages_read} (saved {pages_saved})', end='')
-    
-        print('\nFinalizing database...')
-        print('Generating categories table...')
-        insert_categories(db)
-        print('Categories table generated.')
-        print('Generating category listing table...')
-        insert_category_listing(db)
-        print('Category listing table generated.')
-        print(f'Categories read: {len(categories)}')
+        print('Reading XML file...')
+        stream = open_dump(file_name, workers)
+        if workers > 1:
+            pages = iter_pages_parallel(stream, workers, args.chunk_size)
+        else:
+            pages = iter_pages(stream)
+
+        if args.incremental:
+            import_incremental(db, writer, pages)
+        else:
+            import_full(writer, pages)
+        print('Building indexes...')
+        create_indexes(db)
+        create_fts_index(db)
+        db.commit()
+        print('Indexes built.')
+        print(f'Rows written: {writer.rows_written} ({writer.rows_per_second():.0f} rows/sec)')
+        stream.close()
     except Exception as e:
-        print(e)
+        print(f'Error: {e}')
+        db.rollback()
+        if args.incremental:
+            print('Nothing was changed.')
+        sys.exit(1)
     finally:
-        db.commit()
+        if bulk_load:
+            apply_pragmas(db, SAFE_PRAGMAS)
         db.close()
 
 if __name__ == '__main__':
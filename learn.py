@@ -27,193 +27,408 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import sys
 import os
-import sqlite3
-import nltk
+import json
+import random
 import pickle
+import argparse
+import tempfile
+from array import array
+import database
+import linear
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.preprocessing.text import Tokenizer
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Embedding, GlobalAveragePooling1D
-from keras.regularizers import l2
-from keras.layers import Dropout
-from keras.callbacks import EarlyStopping
-from transform import get_and_normalize
-
-# turn off tensorflow warnings
+from transform import get_and_normalize_pages, get_pages_by_id, iter_chunks, iter_shards, open_cache
+
+# turn off tensorflow warnings; tensorflow itself is only imported by the
+# functions of the keras backend, so the linear backend starts quickly
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
+BACKENDS = ['keras', 'linear']
+
 # number of words to use in the tokenizer
 NUM_WORDS = 60000
 
-def read_random_pages(db, count):
-    db = db.execute('''
-    SELECT title
-    FROM pages
-    ORDER BY RANDOM()
-    LIMIT ?;
-    ''', [count])
+# rounds of random id draws before falling back to a reservoir sample
+SAMPLE_ROUNDS = 8
+
+# pages are cut to their first max length tokens; batches are only padded to
+# the longest page in them, and pages are grouped by these length boundaries
+DEFAULT_MAX_LENGTH = 2000
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_EPOCHS = 50
+BUCKET_BOUNDARIES = [64, 128, 256, 512, 1024, 2048, 4096, 8192]
+
+# texts handed to the tokenizer at a time
+FIT_CHUNK_SIZE = 1000
+
+# pages are split by id (or position): one in ten is held out for validation
+# and one in ten for testing
+SPLIT_MODULUS = 10
+TRAIN, VALIDATION, TEST = 'train', 'validation', 'test'
+
+def reservoir_sample(rows, count):
+    sample = []
+    for i, row in enumerate(rows):
+        if i < count:
+            sample.append(row)
+        else:
+            j = random.randint(0, i)
+            if j < count:
+                sample[j] = row
 
-    return db.fetchall()
+    return sample
 
-def get_categories_for_page(db, page):
+def read_random_pages(db, count):
+    # draw random ids between the smallest and largest page id and keep the
+    # ones that exist, instead of sorting the whole table with ORDER BY RANDOM();
+    # page ids have gaps, so each round draws more ids the fewer hit last time
+    low, high = db.execute('SELECT min(id), max(id) FROM pages').fetchone()
+    if low is None:
+        return []
+
+    sampled = set()
+    draw = count * 2
+    for _ in range(SAMPLE_ROUNDS):
+        candidates = random.sample(range(low, high + 1), min(draw, high - low + 1))
+        found = db.execute('''
+        SELECT id
+        FROM pages
+        WHERE id IN (SELECT value FROM json_each(?));
+        ''', [json.dumps(candidates)]).fetchall()
+        sampled.update(found)
+
+        if len(sampled) >= count or len(candidates) == high - low + 1:
+            return random.sample(sorted(sampled), min(count, len(sampled)))
+
+        hit_rate = max(len(found) / len(candidates), 0.01)
+        draw = int((count - len(sampled)) / hit_rate * 1.5) + 1
+
+    # very sparse ids, read them all once and keep a uniform sample
+    return reservoir_sample(db.execute('SELECT id FROM pages'), count)
+
+def read_category_list(filename):
+    with open(filename, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def get_category_labels(db, categories):
+    # {page title: indexes into categories of the ones the page is in}, for
+    # all the categories at once from one query over category_listing
     db = db.execute('''
-    SELECT name
-    FROM categories
+    SELECT pages.title, wanted.key
+    FROM json_each(?) AS wanted
+    JOIN categories ON categories.name LIKE wanted.value
     JOIN category_listing ON category_listing.category_id = categories.id
-    WHERE category_listing.page_id = (SELECT id FROM pages WHERE title LIKE ?);
-    ''', [page])
-
-    return db.fetchall()
-
-def to_classifier_format(db, page_title_content, category):
-    texts = []
-    labels = []
-
-    for page, content in page_title_content:
-        categories = get_categories_for_page(db, page)
-        words = nltk.word_tokenize(content)
-        texts.append(' '.join(words))
-        
-        if category in categories:
-            labels.append(1)
-        else:
-            labels.append(0)
-
-    return texts, labels
-
-def train_classifier(texts, labels):
+    JOIN pages ON pages.id = category_listing.page_id;
+    ''', [json.dumps(categories)])
+
+    labels = {}
+    for title, index in db:
+        labels.setdefault(title, []).append(index)
+
+    return labels
+
+def get_split(key):
+    # scramble the key first so regular gaps in page ids do not skew the split
+    bucket = (key * 2654435761) % 2 ** 32 % SPLIT_MODULUS
+    if bucket == 0:
+        return TEST
+    if bucket == 1:
+        return VALIDATION
+    return TRAIN
+
+def iter_corpus_examples(db, cache, labels):
+    # every page in the database in id order, normalized through the cache;
+    # yields (text, category indexes, split)
+    rows = db.execute('SELECT id, title, content FROM pages ORDER BY id')
+    for page_id, title, text in get_and_normalize_pages(rows, cache):
+        yield text, labels.get(title, ()), get_split(page_id)
+
+def iter_page_examples(page_title_content, labels):
+    for i, (title, text) in enumerate(page_title_content):
+        yield text, labels.get(title, ()), get_split(i)
+
+class SequenceStore:
+    """Token sequences of one split, packed into a file on disk.
+
+    Sequences are written once and read back through a memory map every
+    epoch, so neither the pages nor their padded sequences are held in
+    memory while training. Each page has a 0/1 label per category.
+    """
+
+    def __init__(self, directory, name, num_labels):
+        self.path = os.path.join(directory, name + '.tokens')
+        self.file = open(self.path, 'wb')
+        self.offsets = array('Q', [0])
+        self.num_labels = num_labels
+        self.labels = array('B')
+
+    def __len__(self):
+        return len(self.labels) // self.num_labels
+
+    def add(self, sequence, indexes):
+        self.file.write(array('I', sequence).tobytes())
+        self.offsets.append(self.offsets[-1] + len(sequence))
+        row = [0] * self.num_labels
+        for index in indexes:
+            row[index] = 1
+        self.labels.extend(row)
+
+    def close(self):
+        self.file.close()
+
+    def iter_sequences(self, shuffle=False):
+        if not self.labels:
+            return
+        tokens = np.memmap(self.path, dtype=np.uint32, mode='r')
+        labels = np.frombuffer(self.labels, dtype=np.uint8).reshape(-1, self.num_labels).astype(np.int32)
+        order = np.random.permutation(len(self)) if shuffle else range(len(self))
+        for i in order:
+            yield tokens[self.offsets[i]:self.offsets[i + 1]].astype(np.int32), labels[i]
+
+def fit_tokenizer(examples):
+    from tensorflow.keras.preprocessing.text import Tokenizer
+
+    # one streaming pass over the training pages
     tokenizer = Tokenizer(num_words=NUM_WORDS, oov_token="<OOV>")
-    tokenizer.fit_on_texts(texts)
-    sequences = tokenizer.texts_to_sequences(texts)
-    padded_sequences = pad_sequences(sequences, padding='post')
-
+    texts = (text for text, _, split in examples if split == TRAIN)
+    for chunk in iter_chunks(texts, FIT_CHUNK_SIZE):
+        tokenizer.fit_on_texts(chunk)
+
+    return tokenizer
+
+def write_sequences(tokenizer, examples, num_labels, max_length, directory):
+    # tokenizes the pages into one store per split and returns the stores and
+    # the longest sequence written; pages without any tokens are left out
+    stores = {split: SequenceStore(directory, split, num_labels) for split in (TRAIN, VALIDATION, TEST)}
+    longest = 0
+    for chunk in iter_chunks(examples, FIT_CHUNK_SIZE):
+        sequences = tokenizer.texts_to_sequences([text for text, _, _ in chunk])
+        for sequence, (_, label, split) in zip(sequences, chunk):
+            sequence = sequence[:max_length]
+            if sequence:
+                stores[split].add(sequence, label)
+                longest = max(longest, len(sequence))
+
+    for store in stores.values():
+        store.close()
+
+    return stores, longest
+
+def make_dataset(store, batch_size, max_length, shuffle=False):
+    import tensorflow as tf
+
+    # streams the store, pads each batch only to the length bucket it falls
+    # in and prepares the next batches while the current one is trained on
+    dataset = tf.data.Dataset.from_generator(
+        lambda: store.iter_sequences(shuffle),
+        output_signature=(tf.TensorSpec(shape=[None], dtype=tf.int32), tf.TensorSpec(shape=[store.num_labels], dtype=tf.int32)))
+    boundaries = [boundary for boundary in BUCKET_BOUNDARIES if boundary < max_length]
+    dataset = dataset.bucket_by_sequence_length(
+        lambda tokens, label: tf.shape(tokens)[0],
+        bucket_boundaries=boundaries,
+        bucket_batch_sizes=[batch_size] * (len(boundaries) + 1))
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def build_classifier(num_labels):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Dense, Dropout, Embedding, GlobalAveragePooling1D
+    from tensorflow.keras.regularizers import l2
+
+    # index 0 is padding and is masked out, so the average only covers the
+    # page's own tokens however far its batch was padded; the embedding is
+    # shared by all categories, each of which gets its own sigmoid output
     model = Sequential([
-    Embedding(NUM_WORDS, 16, input_length=padded_sequences.shape[1]),
+    Embedding(NUM_WORDS, 16, mask_zero=True),
     GlobalAveragePooling1D(),
     Dense(16, activation='relu', kernel_regularizer=l2(0.001)),  # L2 regularization
     Dropout(0.5),  # Dropout layer
-    Dense(1, activation='sigmoid')
+    Dense(num_labels, activation='sigmoid')
 ])
 
-    # Early stopping
-    early_stopping = EarlyStopping(monitor='val_loss', patience=3)
-
     # Compile the model
     model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
-    
-    # Train the model
-    labels = np.array(labels)  # Convert labels to numpy array
-    model.fit(padded_sequences, labels, epochs=50, validation_split=0.2, callbacks=[early_stopping])
 
-    return tokenizer, model
+    return model
 
-def test_classifier(model, tokenizer, texts, labels, max_length):
-    sequences = tokenizer.texts_to_sequences(texts)
-    padded_sequences = pad_sequences(sequences, maxlen=max_length, padding='post')
-    labels = np.array(labels)  # Convert labels to numpy array
+def train_classifier(training, validation, num_labels, epochs):
+    from tensorflow.keras.callbacks import EarlyStopping
 
-    loss, accuracy = model.evaluate(padded_sequences, labels)
+    model = build_classifier(num_labels)
 
-    print(f"Loss: {loss}. Accuracy: {accuracy}")
+    # Early stopping
+    early_stopping = EarlyStopping(monitor='val_loss', patience=3)
 
-def main():
-    category = sys.argv[1]
-    indir = sys.argv[2]
-    dbfile = sys.argv[3]
-    pages = []
-    page_title_content = []
-    db = sqlite3.connect(dbfile)
-    cursor = db.cursor()
+    # Train the model
+    model.fit(training, epochs=epochs, validation_data=validation, callbacks=[early_stopping])
 
-    if not category:
-        print("Error: no category specified.")
-        return
+    return model
 
-    if not indir:
-        print("Error: no indir specified.")
-        return
+def test_classifier(model, testing):
+    loss, accuracy = model.evaluate(testing)
 
-    if not dbfile:
-        print("Error: no dbfile specified.")
-        return
+    print(f"Loss: {loss}. Accuracy: {accuracy}")
 
-    print("Reading page names...")
-    for filename in os.listdir(indir):
-        pages.append(filename)
-    
-    print("Reading pages...")
-    for page in pages:
-        with open(os.path.join(indir, page), 'r') as f:
-            page_title_content.append((page, f.read()))
-
-    # unescape forward slashes
-    for i in range(len(page_title_content)):
-        page = page_title_content[i]
-        page_title_content[i] = (page[0].replace('_', '/'), page[1])
-
-    # read 1000 random pages from the database
+def read_indir(indir):
+    page_title_content = []
+    if any(filename.endswith('.jsonl') for filename in os.listdir(indir)):
+        # sharded export (transform.py --format jsonl), titles are exact
+        print("Reading shards...")
+        for _, title, text in iter_shards(indir):
+            page_title_content.append((title, text))
+    else:
+        print("Reading page names...")
+        pages = os.listdir(indir)
+
+        print("Reading pages...")
+        for page in pages:
+            with open(os.path.join(indir, page), 'r') as f:
+                # unescape forward slashes
+                page_title_content.append((page.replace('_', '/'), f.read()))
+
+    return page_title_content
+
+def read_random_examples(db, cache, count):
+    # read random pages from the database
     print("Reading random pages...")
-    random_pages = read_random_pages(cursor, 1000)
+    random_ids = [page[0] for page in read_random_pages(db, count)]
 
     print("Normalizing random pages... ")
-    page_i = 0
-    for page in random_pages:
-        page_i += 1
-        title = page[0]
-        content = get_and_normalize(cursor, title)
+    page_title_content = []
+    pages_db = cache.db if cache is not None else db
+    for _, title, content in get_and_normalize_pages(get_pages_by_id(pages_db, random_ids), cache):
         page_title_content.append((title, content))
-        print("\rPages normalized: " + str(page_i), end="")
-    
+        print("\rPages normalized: " + str(len(page_title_content)), end="")
+
     print()
+    return page_title_content
 
-    # shuffle the pages
-    print("Shuffling pages...")
-    np.random.shuffle(page_title_content)
+def write_categories(name, categories):
+    # the order of the model's outputs, read back by classify.py
+    with open(name + '.categories', 'w') as f:
+        f.write(''.join(category + '\n' for category in categories))
 
-    # split the pages into training and testing sets
-    training_pages = page_title_content[:800]
-    testing_pages = page_title_content[800:]
+def train_keras(examples, categories, category, args):
+    from tensorflow.keras.models import load_model
 
-    # train the classifier
-    print("Training classifier... ", end='')
-    texts, labels = to_classifier_format(db, training_pages, category)
-    tokenizer, classifier = train_classifier(texts, labels)
-    print("Done.")
+    with tempfile.TemporaryDirectory(prefix='learn-') as workdir:
+        print("Fitting tokenizer... ", end="")
+        tokenizer = fit_tokenizer(examples())
+        print("Done.")
+
+        print("Tokenizing pages... ", end="")
+        stores, max_length = write_sequences(tokenizer, examples(), len(categories), args.max_length, workdir)
+        print(", ".join(f"{len(store)} {split}" for split, store in stores.items()))
 
+        # train the classifier
+        print("Training classifier...")
+        training = make_dataset(stores[TRAIN], args.batch_size, max_length, shuffle=True)
+        validation = make_dataset(stores[VALIDATION], args.batch_size, max_length)
+        classifier = train_classifier(training, validation, len(categories), args.epochs or DEFAULT_EPOCHS)
+        print("Done.")
+
+        print("Saving classifier...")
+        classifier.save(category + '.keras')
+        if len(categories) > 1:
+            write_categories(category, categories)
+        print("Done.")
+
+        print("Maximum sequence length: " + str(max_length))
+        print("Saving tokenizer... ", end="")
+        pickle_filename = category + '.' + str(max_length) + '.pickle'
+        print(pickle_filename)
+        with open(pickle_filename, 'wb') as f:
+            pickle.dump(tokenizer, f)
+
+        # test the classifier
+        if len(stores[TEST]):
+            print("Testing classifier... ", end="")
+            classifier = load_model(category + '.keras')
+            test_classifier(classifier, make_dataset(stores[TEST], args.batch_size, max_length))
+            print("Done.")
+
+def train_linear(examples, categories, category, epochs):
+    # hashed word counts of every split, with a 0/1 label per category
+    print("Hashing pages... ", end="")
+    rows = {split: linear.SparseRows() for split in (TRAIN, VALIDATION, TEST)}
+    labels = {split: array('B') for split in (TRAIN, VALIDATION, TEST)}
+    for text, indexes, split in examples:
+        rows[split].add(text)
+        labels[split].extend(int(i in indexes) for i in range(len(categories)))
+    print(", ".join(f"{len(rows[split])} {split}" for split in rows))
+
+    labels = {split: np.frombuffer(values, dtype=np.uint8).reshape(-1, len(categories)) for split, values in labels.items()}
+
+    print("Training classifier...")
+    classifier = linear.train(rows[TRAIN], labels[TRAIN], categories, epochs, (rows[VALIDATION], labels[VALIDATION]))
     print("Done.")
+
     print("Saving classifier...")
-    classifier.save(category + '.keras')
+    classifier.save(category + '.npz')
     print("Done.")
 
-    # determine maximum sequence length
-    max_length = 0
-    for page, content in page_title_content:
-        words = nltk.word_tokenize(content)
-        if len(words) > max_length:
-            max_length = len(words)
+    if len(rows[TEST]):
+        print("Testing classifier... ", end="")
+        classifier = linear.LinearModel.load(category + '.npz')
+        loss, accuracy = classifier.evaluate(linear.TfidfMatrix(rows[TEST], classifier.idf), labels[TEST])
+        print(f"Loss: {loss}. Accuracy: {accuracy}")
+        print("Done.")
 
-    print("Maximum sequence length: " + str(max_length))
-    print("Saving tokenizer... ", end="")
-    pickle_filename = category + '.' + str(max_length) + '.pickle'
-    print(pickle_filename)
-    with open(pickle_filename, 'wb') as f:
-        pickle.dump(tokenizer, f)
+def main():
+    parser = argparse.ArgumentParser(description='Train a model that tells whether a page belongs to a category.')
+    parser.add_argument('category', help='category to learn, or the model name with --categories')
+    parser.add_argument('indir', help='directory written by transform.py for the category (unused with --corpus)')
+    parser.add_argument('dbfile', help='database file to use')
+    parser.add_argument('--corpus', action='store_true', help='train on every page in the database instead of indir and a random sample')
+    parser.add_argument('--categories', metavar='FILE', help='learn every category listed in FILE (one per line) in one model')
+    parser.add_argument('--random-pages', type=int, default=1000, help='random pages from the database to add to indir')
+    parser.add_argument('--max-length', type=int, default=DEFAULT_MAX_LENGTH, help='tokens of each page to use')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='pages per training batch')
+    parser.add_argument('--epochs', type=int, default=None, help=f'maximum number of training epochs (default {DEFAULT_EPOCHS}, {linear.DEFAULT_EPOCHS} for the linear backend)')
+    parser.add_argument('--backend', choices=BACKENDS, default='keras', help='keras embedding model, or logistic regression on hashed TF-IDF features')
+
+    args = parser.parse_args()
+    category = args.category
+    dbfile = args.dbfile
+    categories = read_category_list(args.categories) if args.categories else [category]
+
+    if not os.path.exists(dbfile):
+        print("Error: dbfile does not exist.")
+        return
 
-        # test the classifier
-        print("Testing classifier... ", end="")
-        classifier = tf.keras.models.load_model(category + '.keras')
-        with open(pickle_filename, 'rb') as fi:
-            tokenizer = pickle.load(fi)
-            texts, labels = to_classifier_format(db, testing_pages, category)
-            test_classifier(classifier, tokenizer, texts, labels, max_length)
+    if not args.corpus and not os.path.isdir(args.indir):
+        print("Error: indir does not exist.")
+        return
 
-        print("Done.")
+    if not categories:
+        print("Error: no categories listed.")
+        return
+
+    db = database.connect(dbfile)
+    cache = open_cache(dbfile)
+    pages_db = cache.db if cache is not None else db
+    labels = get_category_labels(db, categories)
+
+    if args.corpus:
+        # the pages are read from the database once per pass, so nothing
+        # grows with the size of the wiki but the tokenizer's vocabulary
+        examples = lambda: iter_corpus_examples(pages_db, cache, labels)
+    else:
+        page_title_content = read_indir(args.indir)
+        page_title_content += read_random_examples(db, cache, args.random_pages)
+
+        # shuffle the pages
+        print("Shuffling pages...")
+        np.random.shuffle(page_title_content)
+
+        examples = lambda: iter_page_examples(page_title_content, labels)
+
+    if args.backend == 'linear':
+        train_linear(examples(), categories, category, args.epochs or linear.DEFAULT_EPOCHS)
+    else:
+        train_keras(examples, categories, category, args)
 
-    db.close()
+    database.close(db)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,197 @@
+"""
+File: linear.py
+Author: Hypirae 2023
+Version: 1.0.0
+
+License: MIT
+MIT License
+
+Copyright (c) 2023 Hypirae
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+import zlib
+from array import array
+import numpy as np
+
+# words are hashed into this many feature columns, so no vocabulary is kept
+NUM_FEATURES = 1 << 18
+
+# full-batch Adam on the logistic loss
+DEFAULT_EPOCHS = 200
+LEARNING_RATE = 0.5
+L2_PENALTY = 1e-4
+BETAS = (0.9, 0.999)
+
+def hash_word(word):
+    # crc32 rather than hash(), which changes between interpreter runs
+    return zlib.crc32(word.encode('utf-8')) % NUM_FEATURES
+
+class SparseRows:
+    """Hashed word counts of pages, one row per page, in CSR form."""
+
+    def __init__(self):
+        self.indptr = array('Q', [0])
+        self.indices = array('I')
+        self.counts = array('f')
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def add(self, text):
+        counts = {}
+        for word in text.split():
+            feature = hash_word(word)
+            counts[feature] = counts.get(feature, 0) + 1
+
+        for feature in sorted(counts):
+            self.indices.append(feature)
+            self.counts.append(counts[feature])
+        self.indptr.append(len(self.indices))
+
+    def arrays(self):
+        # (row of each entry, column of each entry, count of each entry)
+        indptr = np.frombuffer(self.indptr, dtype=np.uint64).astype(np.int64)
+        rows = np.repeat(np.arange(len(self)), np.diff(indptr))
+        return rows, np.frombuffer(self.indices, dtype=np.uint32).astype(np.int64), np.frombuffer(self.counts, dtype=np.float32)
+
+def fit_idf(rows):
+    # smoothed inverse document frequency of every feature column
+    _, columns, _ = rows.arrays()
+    documents = np.bincount(columns, minlength=NUM_FEATURES)
+    return (np.log((1 + len(rows)) / (1 + documents)) + 1).astype(np.float32)
+
+class TfidfMatrix:
+    """Sublinear TF-IDF weights of SparseRows, with L2-normalized rows."""
+
+    def __init__(self, rows, idf):
+        self.shape = (len(rows), NUM_FEATURES)
+        self.rows, self.columns, counts = rows.arrays()
+        values = (1 + np.log(counts)) * idf[self.columns]
+        norms = np.sqrt(np.bincount(self.rows, weights=values * values, minlength=self.shape[0]))
+        self.values = values / np.maximum(norms, 1e-12)[self.rows]
+
+    def dot(self, weights):
+        # self @ weights for a (features, labels) weight matrix
+        out = np.empty((self.shape[0], weights.shape[1]))
+        for label in range(weights.shape[1]):
+            out[:, label] = np.bincount(self.rows, weights=self.values * weights[self.columns, label], minlength=self.shape[0])
+        return out
+
+    def dot_transposed(self, errors):
+        # self.T @ errors for a (pages, labels) matrix
+        out = np.empty((self.shape[1], errors.shape[1]), dtype=np.float32)
+        for label in range(errors.shape[1]):
+            out[:, label] = np.bincount(self.columns, weights=self.values * errors[self.rows, label], minlength=self.shape[1])
+        return out
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-np.clip(x, -30, 30)))
+
+def log_loss(scores, labels):
+    scores = np.clip(scores, 1e-7, 1 - 1e-7)
+    return float(-np.mean(labels * np.log(scores) + (1 - labels) * np.log(1 - scores)))
+
+class LinearModel:
+    """Logistic regression on hashed TF-IDF features, one output per category.
+
+    Scores have the same (pages, categories) shape as the Keras models'
+    predictions. Saved as a single compressed .npz file.
+    """
+
+    def __init__(self, idf, weights, bias, categories):
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.categories = categories
+
+    def matrix(self, texts):
+        rows = SparseRows()
+        for text in texts:
+            rows.add(text)
+        return TfidfMatrix(rows, self.idf)
+
+    def scores(self, matrix):
+        return sigmoid(matrix.dot(self.weights) + self.bias)
+
+    def predict(self, texts):
+        return self.scores(self.matrix(texts)).astype(np.float32)
+
+    def evaluate(self, matrix, labels):
+        # (loss, accuracy) like model.evaluate
+        scores = self.scores(matrix)
+        return log_loss(scores, labels), float(np.mean((scores >= 0.5) == labels))
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            np.savez_compressed(f, idf=self.idf, weights=self.weights.astype(np.float32),
+                bias=self.bias.astype(np.float32), categories=json.dumps(self.categories))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['idf'], data['weights'], data['bias'], json.loads(str(data['categories'])))
+
+def train(rows, labels, categories, epochs=DEFAULT_EPOCHS, validation=None):
+    """Fits a LinearModel to SparseRows and a (pages, categories) 0/1 array.
+
+    validation is an optional (SparseRows, labels) pair whose loss is shown
+    every ten epochs. The weights, their Adam moments and gradient are each
+    a dense float32 (NUM_FEATURES, categories) array, so memory grows with
+    the number of categories (about 1 MiB per category for each).
+    """
+    idf = fit_idf(rows)
+    matrix = TfidfMatrix(rows, idf)
+    labels = np.asarray(labels, dtype=np.float64).reshape(len(rows), len(categories))
+    weights = np.zeros((NUM_FEATURES, len(categories)), dtype=np.float32)
+    model = LinearModel(idf, weights, np.zeros(len(categories), dtype=np.float32), categories)
+    if validation is not None:
+        validation = (TfidfMatrix(validation[0], idf), np.asarray(validation[1]).reshape(-1, len(categories)))
+
+    parameters = [model.weights, model.bias]
+    moments = [(np.zeros_like(p), np.zeros_like(p)) for p in parameters]
+    for epoch in range(1, epochs + 1):
+        errors = (model.scores(matrix) - labels) / len(rows)
+        gradient = matrix.dot_transposed(errors)
+        gradient += L2_PENALTY * model.weights
+        gradients = [gradient, errors.sum(axis=0).astype(np.float32)]
+        for parameter, gradient, (mean, variance) in zip(parameters, gradients, moments):
+            # updated in place, the step reusing the gradient's memory
+            mean *= BETAS[0]
+            mean += (1 - BETAS[0]) * gradient
+            np.square(gradient, out=gradient)
+            variance *= BETAS[1]
+            variance += (1 - BETAS[1]) * gradient
+            np.divide(variance, 1 - BETAS[1] ** epoch, out=gradient)
+            np.sqrt(gradient, out=gradient)
+            gradient += 1e-8
+            np.divide(mean, gradient, out=gradient)
+            gradient *= LEARNING_RATE / (1 - BETAS[0] ** epoch)
+            parameter -= gradient
+
+        if epoch % 10 == 0 or epoch == epochs:
+            message = f"\rEpoch {epoch}/{epochs} - loss: {log_loss(model.scores(matrix), labels):.4f}"
+            if validation is not None and len(validation[0].values):
+                message += f" - val_loss: {model.evaluate(*validation)[0]:.4f}"
+            print(message, end="")
+
+    print()
+    return model
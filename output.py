@@ -0,0 +1,95 @@
+"""
+File: output.py
+Author: Hypirae 2023
+Version: 1.0.0
+
+License: MIT
+MIT License
+
+Copyright (c) 2023 Hypirae
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import csv
+import sys
+import json
+
+# output formats shared by the command line tools
+FORMATS = ['text', 'tsv', 'jsonl', 'csv']
+
+# rows pulled from a cursor at a time
+FETCH_SIZE = 500
+
+def iter_rows(cursor, offset=0, limit=None):
+    # stream rows with fetchmany, skipping offset rows and stopping after limit
+    while limit is None or limit > 0:
+        size = FETCH_SIZE if limit is None else min(FETCH_SIZE, offset + limit)
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        if offset:
+            skipped = min(offset, len(rows))
+            rows = rows[skipped:]
+            offset -= skipped
+        if limit is not None:
+            rows = rows[:limit]
+            limit -= len(rows)
+        yield from rows
+
+def escape_tsv(value):
+    if value is None:
+        return ''
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def to_json(value):
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError(f'cannot write {type(value).__name__} as JSON')
+
+def write_rows(rows, columns, fmt, out=None):
+    """Writes rows to out (stdout by default) one at a time in the given format.
+
+    text is the old tab-after-every-column output and has no header. Returns
+    the number of rows written.
+    """
+    out = out or sys.stdout
+    count = 0
+
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    elif fmt == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=to_json) + '\n')
+            count += 1
+    elif fmt == 'tsv':
+        out.write('\t'.join(columns) + '\n')
+        for row in rows:
+            out.write('\t'.join(escape_tsv(col) for col in row) + '\n')
+            count += 1
+    else:
+        for row in rows:
+            out.write(''.join(f'{col}\t' for col in row) + '\n')
+            count += 1
+
+    return count
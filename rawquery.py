@@ -1,9 +1,221 @@
 import sys
 import os
+import time
+import ctypes
 import sqlite3
+import argparse
+import database
+from output import FORMATS, iter_rows, write_rows
+
+# sqlite3_db_status() counters, see https://www.sqlite.org/c3ref/c_dbstatus_options.html
+DBSTATUS_CACHE_USED = 1
+DBSTATUS_CACHE_HIT = 7
+DBSTATUS_CACHE_MISS = 8
+DBSTATUS_CACHE_WRITE = 9
+
+# CPython releases whose sqlite3.Connection struct is known to hold the
+# sqlite3 * handle right after the object header (Modules/_sqlite/connection.h)
+CONNECTION_LAYOUT_VERSIONS = ((3, 6), (3, 14))
+
+REPL_HELP = '''Enter SQL statements ending with ';'. Commands:
+    .explain on|off   show the EXPLAIN QUERY PLAN of each statement
+    .timer on|off     show time, rows and bytes of each statement
+    .stats            show page cache hits and misses for this session
+    .readonly on|off  refuse (on) or allow (off) writes in a --write session
+    .mmap BYTES       set PRAGMA mmap_size
+    .cache PAGES      set PRAGMA cache_size (negative for KiB)
+    .format FORMAT    output format (text, tsv, jsonl, csv)
+    .limit N          print at most N rows per statement (0 for no limit)
+    .help             show this message
+    .quit             exit'''
+
+def read_query():
+    # read the query from stdin ending on \n
+    query = ""
+    while True:
+        line = sys.stdin.readline()
+        if line == "\n" or line == "":
+            break
+        query += line
+
+    return query
+
+def get_db_handle(db, dbfile):
+    # the python module does not expose sqlite3_db_status(), so call it
+    # through ctypes on the connection's handle, which is the first field
+    # after the object header in CPython; checked against the file name.
+    # Reading it is only tried where that layout is known, anywhere else the
+    # read could crash the interpreter
+    first, last = CONNECTION_LAYOUT_VERSIONS
+    if sys.implementation.name != 'cpython' or not first <= sys.version_info[:2] <= last:
+        return None
+    if not isinstance(db, sqlite3.Connection):
+        return None
+
+    try:
+        import _sqlite3
+        lib = ctypes.CDLL(_sqlite3.__file__)
+        lib.sqlite3_db_filename.restype = ctypes.c_char_p
+        lib.sqlite3_db_filename.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        lib.sqlite3_db_status.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_int]
+        handle = ctypes.c_void_p.from_address(id(db) + object.__basicsize__).value
+        filename = lib.sqlite3_db_filename(handle, b'main')
+        if filename is None or os.path.realpath(filename.decode()) != os.path.realpath(dbfile):
+            return None
+        return lib, handle
+    except (OSError, AttributeError, ImportError, ValueError):
+        return None
+
+def get_db_status(handle, op):
+    lib, db = handle
+    current = ctypes.c_int()
+    highwater = ctypes.c_int()
+    lib.sqlite3_db_status(db, op, ctypes.byref(current), ctypes.byref(highwater), 0)
+
+    return current.value
+
+def print_stats(handle):
+    if handle is None:
+        print("Page cache statistics are not available.")
+        return
+
+    hits = get_db_status(handle, DBSTATUS_CACHE_HIT)
+    misses = get_db_status(handle, DBSTATUS_CACHE_MISS)
+    ratio = hits / (hits + misses) if hits + misses else 0
+    print(f"Page cache hits: {hits}, misses: {misses} ({ratio:.1%} hit rate)")
+    print(f"Page cache writes: {get_db_status(handle, DBSTATUS_CACHE_WRITE)}")
+    print(f"Page cache memory: {get_db_status(handle, DBSTATUS_CACHE_USED)} bytes")
+
+def split_statements(text):
+    # return the complete statements in text and whatever is left over
+    statements = []
+    start = 0
+    for i, c in enumerate(text):
+        if c == ';' and sqlite3.complete_statement(text[start:i + 1]):
+            statements.append(text[start:i + 1].strip())
+            start = i + 1
+
+    return statements, text[start:]
+
+def value_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return len(value)
+    return 8
+
+def print_query_plan(cursor, statement):
+    depth = {0: -1}
+    for node, parent, _, detail in cursor.execute('EXPLAIN QUERY PLAN ' + statement):
+        depth[node] = depth.get(parent, -1) + 1
+        print('  ' * depth[node] + detail)
+
+def run_statement(cursor, statement, settings):
+    if settings['explain']:
+        print_query_plan(cursor, statement)
+
+    rows_read = 0
+    bytes_read = 0
+
+    def counted(rows):
+        nonlocal rows_read, bytes_read
+        for row in rows:
+            rows_read += 1
+            bytes_read += sum(value_size(col) for col in row)
+            yield row
+
+    started = time.perf_counter()
+    cursor.execute(statement)
+    if cursor.description:
+        columns = [col[0] for col in cursor.description]
+        write_rows(counted(iter_rows(cursor, 0, settings['limit'])), columns, settings['format'])
+    elapsed = time.perf_counter() - started
+
+    if settings['timer']:
+        changed = f", {cursor.rowcount} changed" if cursor.rowcount > 0 else ""
+        print(f"({rows_read} rows, {bytes_read} bytes{changed}, {elapsed * 1000:.1f} ms)")
+
+def run_command(db, handle, line, settings):
+    words = line.split()
+    command = words[0]
+    arg = words[1] if len(words) > 1 else ''
+
+    if command in ('.quit', '.exit'):
+        return False
+    elif command in ('.explain', '.timer'):
+        settings[command[1:]] = arg != 'off'
+    elif command == '.stats':
+        print_stats(handle)
+    elif command == '.readonly':
+        db.execute(f"PRAGMA query_only = {'OFF' if arg == 'off' else 'ON'}")
+    elif command == '.mmap' and arg.isdigit():
+        db.execute(f'PRAGMA mmap_size = {int(arg)}')
+    elif command == '.cache' and arg.lstrip('-').isdigit():
+        db.execute(f'PRAGMA cache_size = {int(arg)}')
+    elif command == '.format' and arg in FORMATS:
+        settings['format'] = arg
+    elif command == '.limit' and arg.isdigit():
+        settings['limit'] = int(arg) or None
+    elif command == '.help':
+        print(REPL_HELP)
+    else:
+        print(f"Error: unknown or incomplete command: {line}")
+
+    return True
+
+def repl(db, dbfile, settings):
+    try:
+        import readline  # noqa: F401 (line editing and history for input())
+    except ImportError:
+        pass
+
+    # autocommit like the sqlite3 shell; use BEGIN/COMMIT for transactions
+    db.isolation_level = None
+    cursor = db.cursor()
+    handle = get_db_handle(db, dbfile)
+    buffer = ''
+    print('Type .help for commands.')
+
+    while True:
+        try:
+            line = input('sqlite> ' if not buffer.strip() else '   ...> ')
+        except EOFError:
+            print()
+            break
+        except KeyboardInterrupt:
+            print()
+            buffer = ''
+            continue
+
+        if not buffer.strip() and line.startswith('.'):
+            if not run_command(db, handle, line.strip(), settings):
+                break
+            continue
+
+        statements, buffer = split_statements(buffer + line + '\n')
+        for statement in statements:
+            try:
+                run_statement(cursor, statement, settings)
+            except sqlite3.Error as e:
+                print(f"Error: {e}")
+            except KeyboardInterrupt:
+                print("Interrupted.")
 
 def main():
-    dbfile = sys.argv[1]
+    parser = argparse.ArgumentParser(description='Run a raw SQL query (read from stdin, ended by a blank line) against the database.')
+    parser.add_argument('dbfile', help='database file to use')
+    parser.add_argument('--format', choices=FORMATS, default='text', help='output format; tsv, jsonl and csv include a header')
+    parser.add_argument('--limit', type=int, default=None, help='maximum number of rows to print')
+    parser.add_argument('--offset', type=int, default=0, help='number of rows to skip')
+    parser.add_argument('--repl', action='store_true', help='keep the connection open and run statements interactively')
+    parser.add_argument('--write', action='store_true', help='open the database for writing (read-only by default)')
+    parser.add_argument('--mmap', type=int, default=None, help='PRAGMA mmap_size in bytes for this session')
+    parser.add_argument('--cache-size', type=int, default=None, help='PRAGMA cache_size for this session (negative for KiB)')
+
+    args = parser.parse_args()
+    dbfile = args.dbfile
 
     if not dbfile:
         print("Error: no dbfile specified.")
@@ -13,25 +225,40 @@ def main():
         print("Error: dbfile does not exist.")
         return
 
-    db = sqlite3.connect(dbfile)
+    db = database.connect(dbfile, read_only=not args.write)
+    if args.mmap is not None:
+        db.execute(f'PRAGMA mmap_size = {args.mmap}')
+    if args.cache_size is not None:
+        db.execute(f'PRAGMA cache_size = {args.cache_size}')
+
+    if args.repl:
+        settings = {
+            'explain': False,
+            'timer': True,
+            'format': args.format,
+            'limit': args.limit,
+        }
+        repl(db, dbfile, settings)
+        database.close(db)
+        return
+
     cursor = db.cursor()
 
-    # read the query from stdin ending on \n
-    query = ""
-    while True:
-        line = sys.stdin.readline()
-        if line == "\n":
-            break
-        query += line
+    query = read_query()
+    try:
+        cursor.execute(query)
+    except sqlite3.OperationalError as e:
+        print(f"Error: {e}")
+        database.close(db)
+        return
 
-    cursor.execute(query)
-    result = cursor.fetchall()
+    # rows are fetched in batches and printed as they arrive
+    columns = [col[0] for col in cursor.description or []]
+    write_rows(iter_rows(cursor, args.offset, args.limit), columns, args.format)
 
-    for row in result:
-        for col in row:
-            print(col, end="\t")
-            
-        print()
+    if args.write:
+        db.commit()
+    database.close(db)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
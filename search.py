@@ -28,37 +28,218 @@ SOFTWARE.
 """
 
 import os
+import re
 import string
 import sqlite3
 import sys
 import argparse
+import multiprocessing
+import database
+from output import FORMATS, write_rows
 
-def search_all(db, query):
+# number of rowid ranges per scan worker; more shards means results start
+# streaming sooner and uneven shards balance out
+SHARDS_PER_WORKER = 16
+
+# state of a scan worker, set up once per process by init_scan_worker
+scan_db = None
+scan_sql = None
+scan_params = None
+
+# results are returned as cursors yielding (id, title) rows in id order, so
+# they can be streamed and paged through with after_id (keyset pagination)
+def search_all(db, query, after_id=0, limit=-1, offset=0):
     db = db.execute('''
-    SELECT title
+    SELECT pages.id, title
     FROM pages
-    WHERE content LIKE ?;
-    ''', [query])
+    WHERE content LIKE ?
+    AND pages.id > ?
+    ORDER BY pages.id
+    LIMIT ? OFFSET ?;
+    ''', [query, after_id, limit, offset])
 
-    return db.fetchall()
+    return db
+
+def search_category(db, category, query, after_id=0, limit=-1, offset=0):
+    db = db.execute('''
+    SELECT pages.id, title
+    FROM pages
+    JOIN category_listing ON category_listing.page_id = pages.id
+    WHERE category_listing.category_id = (SELECT id FROM categories WHERE name LIKE ?)
+    AND content LIKE ?
+    AND pages.id > ?
+    ORDER BY pages.id
+    LIMIT ? OFFSET ?;
+    ''', [category, query, after_id, limit, offset])
+
+    return db
+
+def search_fts(db, query, category=None, limit=50, offset=0):
+    # title matches weigh more than body matches in the bm25 ranking
+    sql = '''
+    SELECT pages_fts.rowid, pages_fts.title, snippet(pages_fts, 1, '[', ']', '...', 16)
+    FROM pages_fts
+    '''
+    params = []
+    if category:
+        sql += '''
+    JOIN category_listing ON category_listing.page_id = pages_fts.rowid
+    WHERE category_listing.category_id = (SELECT id FROM categories WHERE name LIKE ?)
+    AND pages_fts MATCH ?
+    '''
+        params.append(category)
+    else:
+        sql += '''
+    WHERE pages_fts MATCH ?
+    '''
+    sql += '''
+    ORDER BY bm25(pages_fts, 10.0, 1.0)
+    LIMIT ? OFFSET ?;
+    '''
+    params += [query, limit, offset]
+
+    db = db.execute(sql, params)
 
-def search_category(db, category, query):
+    return db
+
+def has_fts_index(db):
     db = db.execute('''
-    SELECT title
+    SELECT 1
+    FROM sqlite_master
+    WHERE name = 'pages_fts';
+    ''')
+
+    return db.fetchone() is not None
+
+def compile_pattern(query, case_sensitive):
+    flags = 0 if case_sensitive else re.IGNORECASE
+    return re.compile(query, flags)
+
+def build_scan_query(query, category, regex, case_sensitive):
+    sql = '''
+    SELECT pages.id, title
     FROM pages
+    '''
+    params = []
+    if category:
+        sql += '''
     JOIN category_listing ON category_listing.page_id = pages.id
     WHERE category_listing.category_id = (SELECT id FROM categories WHERE name LIKE ?)
-    AND content LIKE ?;
-    ''', [category, query])
+    AND pages.id BETWEEN ? AND ?
+    '''
+        params.append(category)
+    else:
+        sql += '''
+    WHERE pages.id BETWEEN ? AND ?
+    '''
+
+    if regex:
+        sql += 'AND content REGEXP ?'
+    elif case_sensitive:
+        # GLOB is the case-sensitive LIKE; translate the SQL wildcards
+        sql += 'AND content GLOB ?'
+        query = like_to_glob(query)
+    else:
+        sql += 'AND content LIKE ?'
+    sql += ' ORDER BY pages.id;'
+
+    return sql, params, query
+
+def like_to_glob(query):
+    glob = []
+    for c in query:
+        if c in '*?[':
+            glob.append('[' + c + ']')
+        elif c == '%':
+            glob.append('*')
+        elif c == '_':
+            glob.append('?')
+        else:
+            glob.append(c)
+
+    return ''.join(glob)
+
+def init_scan_worker(dbfile, sql, params, query, regex, case_sensitive):
+    global scan_db, scan_sql, scan_params
+    scan_db = database.connect(dbfile)
+    if regex:
+        # X REGEXP Y calls regexp(Y, X); Y is always the query, so the
+        # pattern is compiled once here instead of per row
+        pattern = compile_pattern(query, case_sensitive)
+        scan_db.create_function('regexp', 2, lambda _, value: value is not None and pattern.search(value) is not None, deterministic=True)
+    scan_sql = sql
+    scan_params = (params, query)
+
+def scan_shard(shard):
+    start, end = shard
+    params, query = scan_params
+    db = scan_db.execute(scan_sql, params + [start, end, query])
 
     return db.fetchall()
 
+def get_shards(db, count, after_id=0):
+    first, last = db.execute('SELECT min(id), max(id) FROM pages WHERE id > ?;', [after_id]).fetchone()
+    if first is None:
+        return []
+
+    step = max(1, (last - first + count) // count)
+    return [(start, min(start + step - 1, last)) for start in range(first, last + 1, step)]
+
+def scan(dbfile, query, category=None, regex=False, case_sensitive=False, workers=1, max_hits=None, after_id=0):
+    """Scans every page, split into rowid ranges searched in parallel.
+
+    (id, title) rows are yielded as soon as their shard finishes, so they do
+    not come back in any particular order. With max_hits, a shard's rows are
+    only yielded once every lower shard has finished, so the scan stops after
+    the max_hits matches with the lowest ids and the last id can be passed
+    back as after_id to continue.
+    """
+    if max_hits is not None and max_hits <= 0:
+        return
+
+    sql, params, query = build_scan_query(query, category, regex, case_sensitive)
+    initargs = (dbfile, sql, params, query, regex, case_sensitive)
+
+    shards = get_shards(database.connect(dbfile), workers * SHARDS_PER_WORKER, after_id)
+
+    hits = 0
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_scan_worker, initargs)
+        if max_hits is None:
+            results = pool.imap_unordered(scan_shard, shards)
+        else:
+            results = pool.imap(scan_shard, shards)
+    else:
+        pool = None
+        init_scan_worker(*initargs)
+        results = map(scan_shard, shards)
+
+    try:
+        for rows in results:
+            for row in rows:
+                if max_hits is not None and hits >= max_hits:
+                    return
+                yield row
+                hits += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+
 def main():
     # set up argparse
     parser = argparse.ArgumentParser(description='Search the database.')
     parser.add_argument('db', help='database file to use')
     parser.add_argument('query', help='query to search for')
     parser.add_argument('--category', default=None, help='optional category to search within')
+    parser.add_argument('--fts', action='store_true', help='treat the query as a full-text query ("phrase", AND/OR/NOT, prefix*) ranked by relevance')
+    parser.add_argument('--limit', type=int, default=None, help='maximum number of results (full-text searches default to 50)')
+    parser.add_argument('--offset', type=int, default=0, help='number of results to skip')
+    parser.add_argument('--after-id', type=int, default=0, help='only return pages with a larger id (pass the last id of the previous page of results)')
+    parser.add_argument('--format', choices=FORMATS, default='text', help='output format; tsv, jsonl and csv include page ids')
+    parser.add_argument('--regex', action='store_true', help='treat the query as a Python regular expression')
+    parser.add_argument('--case-sensitive', action='store_true', help='match case exactly (LIKE wildcards still apply)')
+    parser.add_argument('--workers', type=int, default=1, help='processes to scan pages with (0 for one per core)')
+    parser.add_argument('--max-hits', type=int, default=None, help='stop scanning after this many matches')
 
     # parse arguments
     args = parser.parse_args()
@@ -72,17 +253,58 @@ def main():
         sys.exit(1)
 
     # open database
-    db = sqlite3.connect(args.db)
+    db = database.connect(args.db)
     cursor = db.cursor()
 
-    if args.category:
-        results = search_category(cursor, args.category, args.query)
+    if args.fts:
+        if not has_fts_index(cursor):
+            print("Error: database has no full-text index, run import.py --migrate on it first.")
+            sys.exit(1)
+
+        limit = 50 if args.limit is None else args.limit
+        try:
+            results = search_fts(cursor, args.query, args.category, limit, args.offset)
+            if args.format == 'text':
+                for _, title, snippet in results:
+                    print(title)
+                    print('    ' + ' '.join(snippet.split()))
+            else:
+                write_rows(results, ['id', 'title', 'snippet'], args.format)
+        except sqlite3.OperationalError as e:
+            print(f"Error: invalid full-text query: {e}")
+            sys.exit(1)
+        return
+
+    if args.regex or args.case_sensitive or args.workers != 1 or args.max_hits is not None:
+        if args.regex:
+            try:
+                compile_pattern(args.query, args.case_sensitive)
+            except re.error as e:
+                print(f"Error: invalid regular expression: {e}")
+                sys.exit(1)
+
+        if args.offset:
+            print("Error: --offset is not supported by scans; use --limit and pass the last id printed to --after-id.")
+            sys.exit(1)
+
+        workers = args.workers or os.cpu_count() or 1
+        max_hits = args.max_hits
+        if args.limit is not None:
+            max_hits = args.limit if max_hits is None else min(max_hits, args.limit)
+        results = scan(args.db, args.query, args.category, args.regex, args.case_sensitive, workers, max_hits, args.after_id)
     else:
-        results = search_all(cursor, args.query)
+        limit = -1 if args.limit is None else args.limit
+        if args.category:
+            results = search_category(cursor, args.category, args.query, args.after_id, limit, args.offset)
+        else:
+            results = search_all(cursor, args.query, args.after_id, limit, args.offset)
 
-    # print results
-    for result in results:
-        print(result[0])
+    # print results as they come in
+    if args.format == 'text':
+        for result in results:
+            print(result[1], flush=True)
+    else:
+        write_rows(results, ['id', 'title'], args.format)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,495 @@
+"""
+File: serve.py
+Author: Hypirae 2023
+Version: 1.0.0
+
+License: MIT
+MIT License
+
+Copyright (c) 2023 Hypirae
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import database
+from classify import load_classifier
+from transform import get_and_normalize_pages, get_pages_by_id, get_pages_by_title, normalize_text, open_cache
+
+DEFAULT_PORT = 8642
+
+# models kept loaded at once, least recently used ones are unloaded first
+DEFAULT_MAX_MODELS = 8
+
+# pages scored per predict call, and how long the first request of a batch
+# waits for others to join it
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT = 0.005
+
+# requests the latency percentiles are computed over
+LATENCY_WINDOW = 10000
+
+class Metrics:
+    """Request, page and batch counters plus recent request latencies."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = dict.fromkeys(['requests', 'errors', 'pages', 'batches', 'model_loads', 'model_evictions'], 0)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            latencies = sorted(self.latencies)
+
+        uptime = time.time() - self.started
+        result = dict(counters)
+        result['uptime'] = round(uptime, 3)
+        result['pages_per_second'] = round(counters['pages'] / uptime, 3) if uptime else 0
+        result['requests_per_second'] = round(counters['requests'] / uptime, 3) if uptime else 0
+        result['average_batch_size'] = round(counters['pages'] / counters['batches'], 3) if counters['batches'] else 0
+        for percentile in (50, 95, 99):
+            value = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)] if latencies else 0
+            result[f'latency_p{percentile}_ms'] = round(value * 1000, 3)
+
+        return result
+
+class Evicted(Exception):
+    pass
+
+class UnknownModel(Exception):
+    pass
+
+class Request:
+    # one client request: ('id', page id), ('title', title) or ('text', wikitext) items
+    def __init__(self, items):
+        self.items = items
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+class PageReader:
+    """Reads and normalizes pages for the batchers of every model.
+
+    All reads of pages and all reads and writes of the normalized page cache
+    go through one thread and its connections, so models never block each
+    other's cache commits and no connection outlives the server.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='page-reader', daemon=True)
+        self.thread.start()
+
+    def read(self, ids, titles):
+        # {('id', id) and ('title', title): (id, title, normalized text)}
+        request = Request((ids, titles))
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+        db = database.connect(self.dbfile)
+        cache = open_cache(self.dbfile)
+        pages_db = cache.db if cache is not None else db
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            try:
+                request.results = self.read_pages(pages_db, cache, *request.items)
+            except Exception as e:
+                request.error = e
+            request.done.set()
+
+        database.close(db)
+        if cache is not None:
+            database.close(cache.db)
+
+    def read_pages(self, db, cache, ids, titles):
+        pages = {}
+        for rows in (get_pages_by_id(db, ids) if ids else [], get_pages_by_title(db, titles) if titles else []):
+            for page_id, title, text in get_and_normalize_pages(rows, cache):
+                pages[('id', page_id)] = pages[('title', title)] = (page_id, title, text)
+
+        return pages
+
+class Batcher:
+    """Scores the requests for one model in micro-batches.
+
+    Requests are queued by the server threads; a single thread per model
+    takes the first waiting request, lets others join it for up to max_wait
+    seconds or until batch_size pages are waiting, and scores them all with
+    one read of the pages and one predict call.
+    """
+
+    def __init__(self, name, predict, categories, reader, metrics, batch_size=DEFAULT_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT):
+        self.name = name
+        self.predict = predict
+        self.categories = categories
+        self.reader = reader
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name=f'batcher-{name}', daemon=True)
+        self.thread.start()
+
+    def submit(self, items):
+        # raises Evicted once the model has been unloaded; requests queued
+        # before that are still scored
+        request = Request(items)
+        with self.lock:
+            if self.stopped:
+                raise Evicted(self.name)
+            self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.requests.put(None)
+
+    def next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        size = len(first.items)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # finish this batch, then stop
+                self.requests.put(None)
+                break
+            batch.append(request)
+            size += len(request.items)
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            try:
+                self.score(batch)
+            except Exception as e:
+                # counted as errors by the handlers of the requests
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+    def score(self, batch):
+        items = [item for request in batch for item in request.items]
+        ids = [value for kind, value in items if kind == 'id']
+        titles = [value for kind, value in items if kind == 'title']
+        pages = self.reader.read(ids, titles) if ids or titles else {}
+
+        # (id, title, normalized text) per item, None for pages not found
+        found = []
+        for kind, value in items:
+            if kind == 'text':
+                found.append((None, None, normalize_text(value)))
+            else:
+                found.append(pages.get((kind, value)))
+
+        texts = [page[2] for page in found if page is not None]
+        scores = iter(self.predict(texts) if texts else [])
+        self.metrics.add('batches')
+        self.metrics.add('pages', len(texts))
+
+        results = []
+        for page in found:
+            if page is None:
+                results.append(None)
+            else:
+                page_scores = next(scores)
+                results.append({
+                    'id': page[0],
+                    'title': page[1],
+                    'scores': {name: round(float(score), 6) for name, score in zip(self.categories, page_scores)},
+                })
+
+        position = 0
+        for request in batch:
+            request.results = results[position:position + len(request.items)]
+            position += len(request.items)
+
+def is_model_name(name):
+    # a bare file name stem: anything that could reach outside the models
+    # directory is refused, since loading a model unpickles its files
+    separators = {'/', '\\', os.sep, os.altsep} - {None}
+    return (isinstance(name, str) and name != '' and not name.startswith('.')
+        and '\x00' not in name and not any(sep in name for sep in separators))
+
+def find_model(directory, name):
+    # (modelfile, tokenizerfile) for a model learn.py saved as name, or None
+    if not is_model_name(name):
+        return None
+
+    modelfile = os.path.join(directory, name + '.npz')
+    if os.path.exists(modelfile):
+        return modelfile, '-'
+
+    modelfile = os.path.join(directory, name + '.keras')
+    tokenizers = glob.glob(os.path.join(glob.escape(directory), glob.escape(name) + '.*.pickle'))
+    if os.path.exists(modelfile) and tokenizers:
+        return modelfile, tokenizers[0]
+
+    return None
+
+class ModelCache:
+    """Batchers of loaded models by name, with least recently used eviction."""
+
+    def __init__(self, directory, reader, metrics, max_models=DEFAULT_MAX_MODELS, **batcher_options):
+        self.directory = directory
+        self.reader = reader
+        self.metrics = metrics
+        self.max_models = max_models
+        self.batcher_options = batcher_options
+        self.models = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        # a model is loaded outside the lock, so requests for other models are
+        # not held up, and only once: requests for a model that is still
+        # loading wait for the same pending load
+        with self.lock:
+            batcher = self.models.get(name)
+            if batcher is not None:
+                self.models.move_to_end(name)
+                return batcher
+
+            pending = self.loading.get(name)
+            owner = pending is None
+            if owner:
+                pending = self.loading[name] = Future()
+
+        if not owner:
+            return pending.result()
+
+        try:
+            files = find_model(self.directory, name)
+            if files is None:
+                raise UnknownModel(name)
+
+            predict, categories = load_classifier(*files)
+            batcher = Batcher(name, predict, categories or [name], self.reader, self.metrics, **self.batcher_options)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[name]
+            pending.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.loading[name]
+            self.models[name] = batcher
+            self.metrics.add('model_loads')
+
+            while len(self.models) > self.max_models:
+                _, evicted = self.models.popitem(last=False)
+                evicted.stop()
+                self.metrics.add('model_evictions')
+
+        pending.set_result(batcher)
+        return batcher
+
+    def names(self):
+        with self.lock:
+            return list(self.models)
+
+class Handler(BaseHTTPRequestHandler):
+    """JSON API:
+
+    POST /classify  {"model": name, "ids": [...], "titles": [...], "texts": [...]}
+    GET /models     names of the loaded models, most recently used last
+    GET /metrics    counters, throughput and latency percentiles
+    """
+
+    def send_json(self, status, value):
+        body = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.server.metrics.snapshot())
+        elif self.path == '/models':
+            self.send_json(200, self.server.models.names())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        started = time.perf_counter()
+        metrics = self.server.metrics
+        metrics.add('requests')
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            name = request['model']
+            items = [('id', int(page_id)) for page_id in request.get('ids', [])]
+            items += [('title', str(title)) for title in request.get('titles', [])]
+            items += [('text', str(text)) for text in request.get('texts', [])]
+        except (ValueError, KeyError, TypeError) as e:
+            metrics.add('errors')
+            self.send_json(400, {'error': f'bad request: {e}'})
+            return
+
+        while True:
+            try:
+                batcher = self.server.models.get(name)
+                results = batcher.submit(items) if items else []
+                break
+            except Evicted:
+                # unloaded between the lookup and the submit, load it again
+                continue
+            except UnknownModel:
+                metrics.add('errors')
+                self.send_json(404, {'error': f'no model named {name}'})
+                return
+            except Exception as e:
+                metrics.add('errors')
+                self.send_json(500, {'error': str(e)})
+                return
+
+        self.send_json(200, {'model': name, 'categories': batcher.categories, 'results': results})
+        metrics.add_latency(time.perf_counter() - started)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class HTTPServer(ThreadingHTTPServer):
+    # the default backlog of 5 resets connections in a burst of requests
+    request_queue_size = 128
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve page classifications from models kept in memory.')
+    parser.add_argument('dbfile', help='database file to use')
+    parser.add_argument('--models', default='.', help='directory of the models written by learn.py, requested by name')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--socket', help='listen on this unix socket instead of a port')
+    parser.add_argument('--max-models', type=int, default=DEFAULT_MAX_MODELS, help='models kept loaded at once')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='most pages scored per prediction')
+    parser.add_argument('--max-wait', type=float, default=DEFAULT_MAX_WAIT * 1000, help='milliseconds a request waits for others to batch with')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dbfile):
+        print("Error: dbfile does not exist.")
+        sys.exit(1)
+
+    if not os.path.isdir(args.models):
+        print("Error: models directory does not exist.")
+        sys.exit(1)
+
+    if args.max_models < 1:
+        # every model would be unloaded as soon as it is loaded
+        print("Error: --max-models must be at least 1.")
+        sys.exit(1)
+
+    metrics = Metrics()
+    reader = PageReader(args.dbfile)
+    models = ModelCache(args.models, reader, metrics, args.max_models, batch_size=args.batch_size, max_wait=args.max_wait / 1000)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        print(f"Listening on {args.socket}")
+    else:
+        server = HTTPServer((args.host, args.port), Handler)
+        print(f"Listening on http://{args.host}:{args.port}")
+
+    server.metrics = metrics
+    server.models = models
+    server.verbose = args.verbose
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+        reader.stop()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
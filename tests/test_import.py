@@ -0,0 +1,122 @@
+"""
+Regression tests for incremental imports (import.py --incremental).
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+IMPORT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'import.py')
+
+def page_xml(page_id, title, revision_id, text):
+    return (f'<page><title>{title}</title><ns>0</ns><id>{page_id}</id><revision><id>{revision_id}</id>'
+            f'<timestamp>2023-01-01T00:00:00Z</timestamp><text xml:space="preserve">{text}</text></revision></page>\n')
+
+def dump_xml(pages):
+    return ('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.11/" version="0.11">\n'
+            + ''.join(page_xml(*page) for page in pages) + '</mediawiki>\n')
+
+class IncrementalImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmp.name, 'wiki.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_import(self, pages, *args, tail='', check=True):
+        dump = os.path.join(self.tmp.name, 'dump.xml')
+        with open(dump, 'w') as f:
+            f.write(dump_xml(pages).replace('</mediawiki>', tail + '</mediawiki>'))
+        return subprocess.run([sys.executable, IMPORT_SCRIPT, dump, self.db, *args], check=check, capture_output=True)
+
+    def query(self, sql):
+        db = sqlite3.connect(self.db)
+        try:
+            return sorted(db.execute(sql).fetchall())
+        finally:
+            db.close()
+
+    def listings(self):
+        return self.query('SELECT pages.title, categories.name FROM category_listing '
+                          'JOIN pages ON pages.id = page_id JOIN categories ON categories.id = category_id')
+
+    def test_deleted_and_recreated_page(self):
+        self.run_import([(1, 'A', 11, 'a [[Category:X]]'), (5, 'B', 15, 'b [[Category:Y]]')])
+        self.run_import([(1, 'A', 11, 'a [[Category:X]]'), (600, 'B', 60, 'new b [[Category:Z]]')], '--incremental')
+
+        self.assertEqual(self.query('SELECT id, title FROM pages'), [(1, 'A'), (600, 'B')])
+        self.assertEqual(self.listings(), [('A', 'X'), ('B', 'Z')])
+
+    def test_recreated_page_is_read_before_the_old_one(self):
+        # the new page comes first in the dump, before the old id is known to be gone
+        self.run_import([(5, 'B', 15, 'b'), (7, 'C', 17, 'c')])
+        self.run_import([(2, 'B', 20, 'new b'), (7, 'C', 17, 'c')], '--incremental')
+
+        self.assertEqual(self.query('SELECT id, title FROM pages'), [(2, 'B'), (7, 'C')])
+
+    def test_pages_swapping_titles(self):
+        self.run_import([(1, 'A', 11, 'a [[Category:X]]'), (2, 'B', 12, 'b [[Category:Y]]')])
+        # only the first page gets a new revision, the second keeps its content
+        self.run_import([(1, 'B', 21, 'a [[Category:X]]'), (2, 'A', 12, 'b [[Category:Y]]')], '--incremental')
+
+        self.assertEqual(self.query('SELECT id, title FROM pages'), [(1, 'B'), (2, 'A')])
+        self.assertEqual(self.listings(), [('A', 'Y'), ('B', 'X')])
+
+    def test_failed_run_changes_nothing(self):
+        self.run_import([(1, 'A', 11, 'a [[Category:X]]'), (2, 'B', 12, 'b')])
+        before = self.query('SELECT * FROM pages'), self.listings(), self.query('SELECT * FROM categories')
+        # the broken page at the end aborts the run after the others were written
+        result = self.run_import([(1, 'A', 21, 'a [[Category:New]]'), (3, 'C', 13, 'c [[Category:Other]]')],
+                                 '--incremental', '--batch-size', '1', tail='<page><title>D</title><ns>0</ns></page>', check=False)
+
+        self.assertEqual(result.returncode, 1)
+        self.assertIn(b'Nothing was changed.', result.stdout)
+        self.assertEqual((self.query('SELECT * FROM pages'), self.listings(), self.query('SELECT * FROM categories')), before)
+
+        # and the next run applies the update in full
+        self.run_import([(1, 'A', 21, 'a [[Category:New]]'), (3, 'C', 13, 'c [[Category:Other]]')], '--incremental')
+        self.assertEqual(self.listings(), [('A', 'New'), ('C', 'Other')])
+        self.assertEqual(self.query('SELECT count(*) FROM category_listing WHERE category_id NOT IN (SELECT id FROM categories)'), [(0,)])
+
+    def test_missing_dump_fails(self):
+        self.run_import([(1, 'A', 11, 'a')])
+        result = subprocess.run([sys.executable, IMPORT_SCRIPT, os.path.join(self.tmp.name, 'missing.xml'), self.db, '--incremental'],
+                                capture_output=True)
+
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(self.query('SELECT id, title FROM pages'), [(1, 'A')])
+
+    def test_migration_moves_revision_columns_before_content(self):
+        self.run_import([(1, 'A', 11, 'a red door [[Category:X]]'), (2, 'B', 12, 'b')])
+        # rebuild the pages table in the schema version 2 column order
+        db = sqlite3.connect(self.db)
+        db.executescript('''
+            CREATE TABLE pages_v2 (id INTEGER PRIMARY KEY, title TEXT NOT NULL, content TEXT,
+                revision_id INTEGER, revision_timestamp TEXT, content_hash TEXT);
+            INSERT INTO pages_v2 SELECT id, title, content, revision_id, revision_timestamp, content_hash FROM pages;
+            DROP TABLE pages;
+            ALTER TABLE pages_v2 RENAME TO pages;
+            PRAGMA user_version = 2;
+        ''')
+        db.close()
+        before = self.query('SELECT id, title, content, revision_id, content_hash FROM pages')
+
+        subprocess.run([sys.executable, IMPORT_SCRIPT, '--migrate', self.db], check=True, capture_output=True)
+
+        db = sqlite3.connect(self.db)
+        columns = [row[1] for row in db.execute('PRAGMA table_info(pages)')]
+        db.close()
+        self.assertEqual(columns, ['id', 'title', 'revision_id', 'revision_timestamp', 'content_hash', 'content'])
+        self.assertEqual(self.query('SELECT id, title, content, revision_id, content_hash FROM pages'), before)
+        self.assertEqual(self.query("SELECT rowid FROM pages_fts WHERE pages_fts MATCH '\"red door\"'"), [(1,)])
+        self.assertEqual(self.query('PRAGMA user_version'), [(3,)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,17 +28,32 @@ SOFTWARE.
 """
 
 import os
-import string
+import re
+import html
+import json
+import time
 import sqlite3
+import string
+import database
 import sys
+import argparse
+import multiprocessing
 import nltk
 from nltk.corpus import stopwords
+from array import array
+from collections import deque
+from itertools import islice
+
+# pages read from the database and handed to a worker at a time
+DEFAULT_CHUNK_SIZE = 50
 
-def print_help():
-    print("Usage: python transform.py <category> <dbfile> <outdir>")
-    print("    category: category to transform")
-    print("    dbfile:   database file to use")
-    print("    outdir:   directory to write files to")
+# pages per shard file of the jsonl export
+DEFAULT_SHARD_SIZE = 10000
+SHARD_NAME = 'shard-{:05d}'
+VOCABULARY_FILE = 'vocab.txt'
+
+# bump whenever normalize_text changes its output, so cached pages are redone
+NORMALIZER_VERSION = 3
 
 def get_category_members(db, category):
     db = db.execute('''
@@ -50,34 +65,195 @@ def get_category_members(db, category):
 
     return db.fetchall()
 
+def count_category_members(db, category):
+    db = db.execute('''
+    SELECT count(*)
+    FROM category_listing
+    WHERE category_listing.category_id = (SELECT id FROM categories WHERE name LIKE ?);
+    ''', [category])
+
+    return db.fetchone()[0]
+
+def get_category_pages(db, category, after_id=0):
+    # one join keyed on page id, streamed from the cursor; after_id skips
+    # the pages up to and including that id
+    db = db.execute('''
+    SELECT pages.id, title, content
+    FROM pages
+    JOIN category_listing ON category_listing.page_id = pages.id
+    WHERE category_listing.category_id = (SELECT id FROM categories WHERE name LIKE ?)
+    AND pages.id > ?
+    ORDER BY pages.id;
+    ''', [category, after_id])
+
+    return db
+
+def get_all_pages(db, after_id=0):
+    db = db.execute('''
+    SELECT id, title, content
+    FROM pages
+    WHERE id > ?
+    ORDER BY id;
+    ''', [after_id])
+
+    return db
+
+def get_pages_by_id(db, page_ids):
+    # the ids are passed as one JSON array so any number of them is a single
+    # query of primary key lookups; rows come back in page id order
+    db = db.execute('''
+    SELECT id, title, content
+    FROM pages
+    WHERE id IN (SELECT value FROM json_each(?))
+    ORDER BY id;
+    ''', [json.dumps(list(page_ids))])
+
+    return db
+
+def get_pages_by_title(db, titles):
+    # exact titles, looked up through the unique title index in one query
+    db = db.execute('''
+    SELECT id, title, content
+    FROM pages
+    WHERE title IN (SELECT value FROM json_each(?))
+    ORDER BY id;
+    ''', [json.dumps(list(titles))])
+
+    return db
+
+def iter_chunks(rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
 def get_page_content(db, page):
     db = db.execute('''
     SELECT content
     FROM pages
-    WHERE title LIKE ?;
+    WHERE title = ?;
     ''', [page])
 
     return db.fetchone()[0]
 
+# wikitext markup removed by strip_wikitext, in the order it is applied
+WIKI_COMMENT = re.compile(r'<!--.*?(?:-->|$)', re.DOTALL)
+WIKI_DROPPED_TAGS = 'ref|references|gallery|math|score|syntaxhighlight|source|timeline|imagemap|templatedata'
+WIKI_DROPPED_BLOCK = re.compile(r'<(' + WIKI_DROPPED_TAGS + r')\b[^>]*?(?:/>|>.*?</\1\s*>)', re.DOTALL | re.IGNORECASE)
+WIKI_TEMPLATE_BRACES = re.compile(r'\{\{|\}\}')
+WIKI_TABLE_BRACES = re.compile(r'\{\||\|\}')
+WIKI_INNER_LINK = re.compile(r'\[\[([^\[\]]*)\]\]')
+# only links without a leading colon categorize or embed; [[:Category:Foo]]
+# is an ordinary link shown as its label
+WIKI_DROPPED_LINK = re.compile(r'\s*(?:category|file|image|media)\s*:', re.IGNORECASE)
+WIKI_EXTERNAL_LINK = re.compile(r'\[(?:https?:)?//[^\s\]]*\s*([^\]]*)\]')
+WIKI_URL = re.compile(r'https?://\S+')
+WIKI_TAG = re.compile(r'</?[a-zA-Z][^>]*>')
+WIKI_FORMATTING = re.compile(r"'{2,}")
+WIKI_HEADING = re.compile(r'^(=+)\s*(.*?)\s*\1\s*$', re.MULTILINE)
+WIKI_LINE_PREFIX = re.compile(r'^(?:[*#:;]+|-{4,})', re.MULTILINE)
+WIKI_MAGIC_WORD = re.compile(r'__[A-Z]+__')
+
+# characters removed from every token by normalize_text
+STRIP_TABLE = str.maketrans('', '', string.punctuation + string.digits)
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+DIGITS_TABLE = str.maketrans('', '', string.digits)
+
+# loaded from the nltk corpus on first use
+stop_words = None
+
+def get_stop_words():
+    global stop_words
+    if stop_words is None:
+        stop_words = frozenset(stopwords.words('english'))
+
+    return stop_words
+
 def strip_stopwords(text):
-    stop_words = set(stopwords.words('english'))
+    stop_words = get_stop_words()
     word_tokens = nltk.word_tokenize(text)
     filtered_sentence = [w for w in word_tokens if not w in stop_words]
 
     return ' '.join(filtered_sentence)
 
 def strip_punctuation(text):
-    return text.translate(str.maketrans('', '', string.punctuation))
+    return text.translate(PUNCTUATION_TABLE)
 
 def strip_numbers(text):
-    return text.translate(str.maketrans('', '', string.digits))
+    return text.translate(DIGITS_TABLE)
+
+def remove_nested(text, braces, opener):
+    # drop every outermost opener...closer region, counting nesting depth;
+    # an opener that is never closed is left in place
+    parts = []
+    depth = 0
+    last = 0
+    start = 0
+    for match in braces.finditer(text):
+        if match.group() == opener:
+            if depth == 0:
+                start = match.start()
+                parts.append(text[last:start])
+            depth += 1
+        elif depth:
+            depth -= 1
+            if depth == 0:
+                last = match.end()
+
+    parts.append(text[start if depth else last:])
+    return ''.join(parts)
+
+def replace_link(match):
+    link = match.group(1)
+    if WIKI_DROPPED_LINK.match(link):
+        return ''
+    label = link.rsplit('|', 1)[-1]
+    if '|' not in link:
+        # [[:Category:Foo]] is shown as Category:Foo
+        label = label.lstrip().lstrip(':')
+    return label
+
+def strip_wikitext(text):
+    """Removes wikitext markup and keeps the prose.
+
+    Comments, refs and similar blocks, templates, tables, category and file
+    links, HTML tags and formatting are removed; links are replaced by their
+    label and headings by their text.
+    """
+    text = WIKI_COMMENT.sub('', text)
+    text = WIKI_DROPPED_BLOCK.sub(' ', text)
+    text = remove_nested(text, WIKI_TEMPLATE_BRACES, '{{')
+    text = remove_nested(text, WIKI_TABLE_BRACES, '{|')
+
+    # innermost links first, so file captions containing links go as a whole
+    while True:
+        text, count = WIKI_INNER_LINK.subn(replace_link, text)
+        if not count:
+            break
+
+    text = WIKI_EXTERNAL_LINK.sub(r'\1', text)
+    text = WIKI_URL.sub('', text)
+    text = WIKI_TAG.sub(' ', text)
+    text = WIKI_FORMATTING.sub('', text)
+    text = WIKI_HEADING.sub(r'\2', text)
+    text = WIKI_LINE_PREFIX.sub('', text)
+    text = WIKI_MAGIC_WORD.sub('', text)
+
+    return html.unescape(text)
 
 def normalize_text(text):
-    text = strip_stopwords(text)
-    text = strip_punctuation(text)
-    text = strip_numbers(text)
+    # strip_wikitext, then the same result as strip_stopwords,
+    # strip_punctuation and strip_numbers in turn, but done in one pass over
+    # the tokens
+    stop_words = get_stop_words()
+    word_tokens = nltk.word_tokenize(strip_wikitext(text))
+
+    return ' '.join([w.translate(STRIP_TABLE) for w in word_tokens if w not in stop_words])
 
-    return text
+def normalize_texts(texts):
+    return [normalize_text(text) for text in texts]
 
 def get_and_normalize(db, page):
     content = get_page_content(db, page)
@@ -85,43 +261,345 @@ def get_and_normalize(db, page):
 
     return content
 
-def main():
-    if len(sys.argv) == 2:
-        if sys.argv[1] == '--help' or sys.argv[1] == '-h':
-            print_help()
+class NormalizedCache:
+    """Normalized text and word-id sequences of pages, stored in the database.
+
+    Entries are keyed on page id, the content hash import.py stores with the
+    page and NORMALIZER_VERSION, so a page is normalized again whenever its
+    content or the normalizer changes. Word ids index the normalized_words
+    table and are shared by all pages.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.words = None
+        columns = [row[1] for row in db.execute('PRAGMA table_info(pages)')]
+        if 'content_hash' not in columns:
+            raise sqlite3.OperationalError('pages have no content hashes, run import.py --migrate')
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS normalized_pages (
+            page_id INTEGER PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            normalizer_version INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            tokens BLOB NOT NULL
+        )
+        ''')
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS normalized_words (
+            id INTEGER PRIMARY KEY,
+            word TEXT NOT NULL UNIQUE
+        )
+        ''')
+        db.commit()
+
+    def lookup(self, chunk):
+        # returns {page id: normalized text} for the rows still up to date
+        db = self.db.execute('''
+        SELECT normalized_pages.page_id, text
+        FROM normalized_pages
+        JOIN pages ON pages.id = normalized_pages.page_id
+        WHERE normalized_pages.page_id IN (SELECT value FROM json_each(?))
+        AND normalizer_version = ?
+        AND normalized_pages.content_hash = pages.content_hash;
+        ''', [json.dumps([page_id for page_id, _, _ in chunk]), NORMALIZER_VERSION])
+
+        return dict(db)
+
+    def add_words(self, texts):
+        # word ids are assigned by sqlite, so other connections and processes
+        # filling the cache at the same time agree on them; self.words only
+        # remembers the ids already looked up
+        if self.words is None:
+            self.words = dict((word, word_id) for word_id, word in self.db.execute('SELECT id, word FROM normalized_words'))
+
+        new_words = set()
+        for text in texts:
+            new_words.update(word for word in text.split() if word not in self.words)
+        if not new_words:
             return
 
-    if len(sys.argv) < 4:
-        print('Error: not enough arguments.')
-        print_help()
+        self.db.executemany('INSERT OR IGNORE INTO normalized_words(word) VALUES (?)', [(word,) for word in new_words])
+        db = self.db.execute('''
+        SELECT id, word
+        FROM normalized_words
+        WHERE word IN (SELECT value FROM json_each(?));
+        ''', [json.dumps(list(new_words))])
+        self.words.update((word, word_id) for word_id, word in db)
+
+    def word_ids(self, text):
+        return array('I', [self.words[word] for word in text.split()])
+
+    def tokenize(self, texts):
+        # word ids of texts that are not stored, e.g. pages without a hash
+        texts = list(texts)
+        try:
+            self.add_words(texts)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            self.words = None
+            raise
+
+        return [self.word_ids(text) for text in texts]
+
+    def store(self, normalized):
+        try:
+            self.add_words(text for _, _, text in normalized)
+            rows = []
+            for page_id, _, text in normalized:
+                rows.append((NORMALIZER_VERSION, text, self.word_ids(text).tobytes(), page_id))
+            # pages imported before content hashes were kept are not cached
+            self.db.executemany('''
+            INSERT OR REPLACE INTO normalized_pages
+            SELECT id, content_hash, ?, ?, ? FROM pages WHERE id = ? AND content_hash IS NOT NULL;
+            ''', rows)
+            self.db.commit()
+        except sqlite3.Error:
+            # the ids of words added in this transaction are gone too
+            self.db.rollback()
+            self.words = None
+            raise
+
+def open_cache(dbfile):
+    # the cache is the one thing the read-side tools write, so it gets an
+    # explicitly writable connection; pages being cached must be read through
+    # cache.db too, since a read cursor on another connection would keep the
+    # cache from committing. Without write access pages are just normalized.
+    try:
+        return NormalizedCache(database.connect(dbfile, read_only=False))
+    except sqlite3.OperationalError as e:
+        print(f"Warning: normalized page cache disabled: {e}")
+        return None
+
+def get_cached_tokens(db, page_ids):
+    # (page id, word ids) for cached pages still up to date, in page id order
+    db = db.execute('''
+    SELECT page_id, tokens
+    FROM normalized_pages
+    JOIN pages ON pages.id = normalized_pages.page_id
+    WHERE page_id IN (SELECT value FROM json_each(?))
+    AND normalizer_version = ?
+    AND normalized_pages.content_hash = pages.content_hash
+    ORDER BY page_id;
+    ''', [json.dumps(list(page_ids)), NORMALIZER_VERSION])
+
+    for page_id, tokens in db:
+        ids = array('I')
+        ids.frombytes(tokens)
+        yield page_id, ids
+
+def get_and_normalize_pages(pages, cache=None):
+    # takes (id, title, content) rows, e.g. from get_category_pages
+    for chunk in iter_normalized(iter_chunks(pages), 1, cache=cache):
+        yield from chunk
+
+def normalize_chunk(chunk):
+    return [(page_id, title, normalize_text(content)) for page_id, title, content in chunk]
+
+def split_cached(chunk, cache):
+    if cache is None:
+        return {}, chunk
+
+    cached = cache.lookup(chunk)
+    return cached, [row for row in chunk if row[0] not in cached]
+
+def merge_cached(chunk, cached, normalized, cache):
+    if cache is not None and normalized:
+        cache.store(normalized)
+
+    texts = dict(cached)
+    texts.update((page_id, text) for page_id, _, text in normalized)
+    return [(page_id, title, texts[page_id]) for page_id, title, _ in chunk]
+
+def next_result(pending, ordered):
+    if ordered:
+        job = pending.popleft()
+    else:
+        # take whichever chunk finishes first
+        job = None
+        while job is None:
+            for candidate in pending:
+                if candidate[2].ready():
+                    job = candidate
+                    break
+            else:
+                pending[0][2].wait(0.01)
+        pending.remove(job)
+
+    chunk, cached, result, cache = job
+    return merge_cached(chunk, cached, result.get(), cache)
+
+def iter_normalized(chunks, workers, ordered=True, cache=None):
+    """Normalizes chunks of (id, title, content) rows in a process pool.
+
+    Yields lists of (id, title, normalized content). Chunks are read in this
+    process and only a few are in flight at once, so memory stays bounded.
+    Pages found in the cache are not normalized again, the rest are added.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            cached, misses = split_cached(chunk, cache)
+            yield merge_cached(chunk, cached, normalize_chunk(misses), cache)
         return
 
-    category = sys.argv[1]
-    dbfile = sys.argv[2]
-    outdir = sys.argv[3]
+    max_in_flight = workers * 2
+    pending = deque()
+    with multiprocessing.Pool(workers) as pool:
+        for chunk in chunks:
+            cached, misses = split_cached(chunk, cache)
+            pending.append((chunk, cached, pool.apply_async(normalize_chunk, (misses,)), cache))
+            if len(pending) >= max_in_flight:
+                yield next_result(pending, ordered)
+
+        while pending:
+            yield next_result(pending, ordered)
+
+def write_page(outdir, title, content):
+    # escape forward slashes
+    title = title.replace('/', '_')
+    with open(os.path.join(outdir, title), 'w') as f:
+        f.write(content)
+
+class ShardWriter:
+    """Writes normalized pages into a few large shard files.
+
+    Every shard is a JSON Lines file of {"id", "title", "text"} objects. With
+    tokens=True each shard also gets a .tokens file (little-endian uint32
+    word ids of all its pages back to back) and an .offsets file (uint64,
+    one more than the number of pages) so page i's ids are
+    tokens[offsets[i]:offsets[i + 1]]; both can be memory-mapped, e.g. with
+    numpy.memmap. Word ids start at 1 and word i is line i of vocab.txt.
+
+    With a NormalizedCache the word ids are read from the cache instead of
+    being assigned here, and vocab.txt is the cache's whole vocabulary.
+    """
+
+    def __init__(self, outdir, shard_size=DEFAULT_SHARD_SIZE, tokens=False, cache=None):
+        self.outdir = outdir
+        self.shard_size = shard_size
+        self.tokens = tokens
+        self.cache = cache
+        self.words = {}
+        self.shard = -1
+        self.pages_in_shard = 0
+        self.jsonl = None
+
+    def open_shard(self):
+        self.close_shard()
+        self.shard += 1
+        self.pages_in_shard = 0
+        name = os.path.join(self.outdir, SHARD_NAME.format(self.shard))
+        self.jsonl = open(name + '.jsonl', 'w', encoding='utf-8')
+        if self.tokens:
+            self.token_file = open(name + '.tokens', 'wb')
+            self.offset_file = open(name + '.offsets', 'wb')
+            self.offset = 0
+            array('Q', [0]).tofile(self.offset_file)
+
+    def close_shard(self):
+        if self.jsonl is None:
+            return
+        self.jsonl.close()
+        if self.tokens:
+            self.token_file.close()
+            self.offset_file.close()
+        self.jsonl = None
+
+    def write_chunk(self, chunk):
+        # the pages of a normalized chunk are in the cache by now, so their
+        # word ids are read back in one query rather than worked out again
+        cached = {}
+        if self.tokens and self.cache is not None:
+            cached = dict(get_cached_tokens(self.cache.db, [page_id for page_id, _, _ in chunk]))
+            missing = [(page_id, text) for page_id, _, text in chunk if page_id not in cached]
+            if missing:
+                cached.update(zip([page_id for page_id, _ in missing], self.cache.tokenize(text for _, text in missing)))
+
+        for page_id, title, text in chunk:
+            self.write(page_id, title, text, cached.get(page_id))
+
+    def write(self, page_id, title, text, ids=None):
+        if self.jsonl is None or self.pages_in_shard >= self.shard_size:
+            self.open_shard()
+
+        self.jsonl.write(json.dumps({'id': page_id, 'title': title, 'text': text}, ensure_ascii=False) + '\n')
+        self.pages_in_shard += 1
+
+        if self.tokens:
+            if ids is None:
+                ids = array('I', [self.words.setdefault(word, len(self.words) + 1) for word in text.split()])
+            if sys.byteorder != 'little':
+                ids.byteswap()
+            ids.tofile(self.token_file)
+            self.offset += len(ids)
+            offset = array('Q', [self.offset])
+            if sys.byteorder != 'little':
+                offset.byteswap()
+            offset.tofile(self.offset_file)
+
+    def close(self):
+        self.close_shard()
+        if not self.tokens:
+            return
+
+        words = enumerate(self.words, 1)
+        if self.cache is not None:
+            words = self.cache.db.execute('SELECT id, word FROM normalized_words ORDER BY id')
+
+        with open(os.path.join(self.outdir, VOCABULARY_FILE), 'w', encoding='utf-8') as f:
+            line = 1
+            for word_id, word in words:
+                # ids left unused by rolled back cache writes get empty lines
+                f.write('\n' * (word_id - line) + word + '\n')
+                line = word_id + 1
+
+def iter_shards(indir):
+    # (id, title, text) of every page in a jsonl export, shard by shard
+    for filename in sorted(os.listdir(indir)):
+        if not filename.endswith('.jsonl'):
+            continue
+        with open(os.path.join(indir, filename), 'r', encoding='utf-8') as f:
+            for line in f:
+                page = json.loads(line)
+                yield page['id'], page['title'], page['text']
+
+def main():
+    parser = argparse.ArgumentParser(description='Normalize the pages of a category and write them to a directory.')
+    parser.add_argument('category', help='category to transform')
+    parser.add_argument('dbfile', help='database file to use')
+    parser.add_argument('outdir', help='directory to write files to')
+    parser.add_argument('--workers', type=int, default=1, help='processes to normalize pages with (0 for one per core)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='pages handed to a worker at a time')
+    parser.add_argument('--unordered', action='store_true', help='write pages as soon as they are done instead of in page id order')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or fill the normalized page cache in the database')
+    parser.add_argument('--format', choices=['files', 'jsonl'], default='files', help='one file per page, or a few large JSON Lines shards')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE, help='pages per shard with --format jsonl')
+    parser.add_argument('--tokens', action='store_true', help='with --format jsonl, also write packed word-id arrays and a vocabulary')
+
+    args = parser.parse_args()
+    category = args.category
+    dbfile = args.dbfile
+    outdir = args.outdir
 
     if not category:
         print("Error: no category specified.")
-        print_help()
+        parser.print_help()
         return
 
     if not dbfile:
         print("Error: no dbfile specified.")
-        print_help()
+        parser.print_help()
         return
 
     if not os.path.exists(dbfile):
         print("Error: dbfile does not exist.")
-        print_help()
+        parser.print_help()
         return
 
     if not outdir:
         print("Error: no outdir specified.")
-        print_help()
-        return
-
-    if not category and not dbfile and not outdir:
-        print("Usage: python transform.py <category> <dbfile> <outdir>")
+        parser.print_help()
         return
 
     print("Downloading nltk stopwords...")
@@ -133,24 +611,33 @@ def main():
         os.makedirs(outdir)
 
     print("Connecting to database...")
-    db = sqlite3.connect(dbfile)
-    cursor = db.cursor()
+    cache = None if args.no_cache else open_cache(dbfile)
+    db = cache.db if cache is not None else database.connect(dbfile)
     print("Done.")
     print("Getting category members...")
-    members = get_category_members(db, category)
-    print("Done.")
+    total = count_category_members(db, category)
+    print(f"Done. {total} pages.")
 
     print("Normalizing and writing to files...")
-    for member in members:
-        title = member[0]
-        content = get_and_normalize(db, title)
-
-        # escape forward slashes
-        title = title.replace('/', '_')
-        with open(os.path.join(outdir, title), 'w') as f:
-            f.write(content)
-
-    db.close()
+    workers = args.workers or os.cpu_count() or 1
+    chunks = iter_chunks(get_category_pages(db, category), args.chunk_size)
+    written = 0
+    started = time.time()
+    shards = ShardWriter(outdir, args.shard_size, args.tokens, cache) if args.format == 'jsonl' else None
+    for chunk in iter_normalized(chunks, workers, not args.unordered, cache):
+        if shards is not None:
+            shards.write_chunk(chunk)
+        else:
+            for page_id, title, content in chunk:
+                write_page(outdir, title, content)
+        written += len(chunk)
+        rate = written / max(time.time() - started, 1e-9)
+        print(f"\rPages written: {written}/{total} ({rate:.1f} pages/sec)", end="")
+
+    print()
+    if shards is not None:
+        shards.close()
+    database.close(db)
     print("Done.")
 
 if __name__ == '__main__':